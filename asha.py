@@ -0,0 +1,157 @@
+import argparse
+import os
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from main import check_args, load_corpus
+from sweep import sweep_parser, grid, cpu_slices, result_path, run_job
+from utils import batchify
+
+###############################################################################
+# Asynchronous successive halving (ASHA) over the sweep grid of sweep.py
+#
+# Trials are trained in segments up to the rung epochs min_epochs * eta^k. Each
+# segment continues from the trial's stored training state (main.py --state).
+# Whenever a worker becomes free, the best not yet promoted trial in the top
+# 1/eta of a rung is trained up to the next rung, otherwise a new trial is
+# started. Hopeless configurations therefore stop after min_epochs.
+###############################################################################
+
+asha_parser = argparse.ArgumentParser(parents=[sweep_parser], add_help=False,
+                                      description='Successive halving hyperparameter search for main.py')
+asha_parser.add_argument('--min_epochs', type=int, default=1,
+                         help='epochs of the first rung')
+asha_parser.add_argument('--eta', type=int, default=3,
+                         help='reduction factor, the top 1/eta trials of a rung are promoted')
+
+
+def rungs(min_epochs, max_epochs, eta):
+    # rung epochs min_epochs * eta^k, the last rung is always max_epochs
+    epochs = [min_epochs]
+    while epochs[-1] * eta < max_epochs:
+        epochs.append(epochs[-1] * eta)
+    return epochs if epochs[-1] == max_epochs else epochs + [max_epochs]
+
+class SuccessiveHalving(object):
+
+    def __init__(self, configs, rung_epochs, eta, evaluate_every=1):
+        self.configs = dict(configs)
+        self.pending = [key for key, _ in configs]
+        self.rung_epochs = rung_epochs
+        self.eta = eta
+        self.evaluate_every = evaluate_every
+
+        # epochs trained per trial, best validation loss of every trial that reached a rung
+        # and the (trial, rung) pairs which were already promoted
+        self.epochs = {}
+        self.rungs = [dict() for _ in rung_epochs]
+        self.promoted = set()
+
+    def record(self, key, epochs, valid_loss):
+        # valid_loss is the whole validation curve of the trial so far
+        self.epochs[key] = epochs
+        for k, rung_epoch in enumerate(self.rung_epochs):
+            curve = valid_loss[:rung_epoch // self.evaluate_every]
+            if rung_epoch <= epochs and len(curve) > 0:
+                self.rungs[k][key] = min(curve)
+                if rung_epoch < epochs:
+                    self.promoted.add((key, k))
+        if key in self.pending:
+            self.pending.remove(key)
+
+    def next_job(self, running):
+        # returns (key, epochs) of the next segment to train or None
+
+        # promote from the highest rung first
+        for k in reversed(range(len(self.rung_epochs) - 1)):
+            rung = sorted(self.rungs[k], key=lambda key: self.rungs[k][key])
+            for key in rung[:len(rung) // self.eta]:
+                if (key, k) not in self.promoted and key not in running:
+                    self.promoted.add((key, k))
+                    return key, self.rung_epochs[k + 1]
+
+        if len(self.pending) > 0:
+            key = self.pending.pop(0)
+            return key, self.rung_epochs[0]
+        return None
+
+    def best(self):
+        # trial with the lowest validation loss at the highest rung reached by any trial
+        rung = [r for r in self.rungs if len(r) > 0][-1]
+        key = min(rung, key=lambda key: rung[key])
+        return key, rung[key]
+
+    def epochs_trained(self):
+        return sum(self.epochs.values())
+
+
+def asha(args):
+
+    os.makedirs(args.results, exist_ok=True)
+
+    configs = grid(args)
+    rung_epochs = rungs(args.min_epochs, args.epochs, args.eta)
+    scheduler = SuccessiveHalving(configs, rung_epochs, args.eta, args.evaluate_every)
+    print('ASHA: {} configurations, rungs at epochs {}, {} workers'.format(len(configs), rung_epochs, args.workers))
+
+    # pick up trials of an interrupted search
+    for key, _ in configs:
+        if os.path.exists(result_path(args.results, key)):
+            with open(result_path(args.results, key), 'r') as f:
+                result = json.load(f)
+            scheduler.record(key, result['epochs'], result['valid_loss'])
+
+    # build the corpus cache (or publish the shared corpus and batches) once so the workers only read it
+    corpus = load_corpus(args)
+    if args.shared_data and not args.reinit_h:
+        batchify(corpus.train, args.batch_size, argparse.Namespace(cuda=False, shared_data=args.shared_data), 'train')
+
+    ctx = multiprocessing.get_context('spawn')
+    slots = ctx.Manager().Queue()
+    for cpus in cpu_slices(args.workers, args.threads):
+        slots.put(cpus)
+
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=ctx) as executor:
+        running = {}
+        while True:
+            while len(running) < args.workers:
+                job = scheduler.next_job(set(running.values()))
+                if job is None:
+                    break
+                key, epochs = job
+                settings = dict(scheduler.configs[key], epochs=epochs, skip_test=epochs < args.epochs,
+                                state=os.path.join(args.results, key + '.state'))
+                running[executor.submit(run_job, key, settings, args, slots)] = key
+            if len(running) == 0:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                key, result = future.result()
+                scheduler.record(key, result['epochs'], result['valid_loss'])
+                print('| {} | epoch {:3d} | best valid loss {:5.2f}'.format(key, result['epochs'], min(result['valid_loss'])))
+
+    full_grid = len(configs) * args.epochs
+    trained = scheduler.epochs_trained()
+    print('=' * 89)
+    print('| ASHA done in {:5.2f}s | {} of {} epochs of the full grid trained | compute saved {:5.1f}%'.format(
+        time.time() - start_time, trained, full_grid, 100. * (1. - trained / full_grid)))
+    print('| best configuration {} | valid loss {:5.2f}'.format(*scheduler.best()))
+    print('=' * 89)
+
+    return scheduler
+
+
+if __name__ == '__main__':
+
+    args = asha_parser.parse_args()
+    check_args(args, asha_parser.error)
+    args.tied = True
+    args.dump_entropy = None
+    args.dump_valloss = None
+
+    asha(args)
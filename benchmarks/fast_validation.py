@@ -0,0 +1,78 @@
+###############################################################################
+# Cost versus accuracy of subsampled validation (main.py --fast_valid)
+#
+# Scores the full validation set once and then estimates its loss on random
+# subsets of several sizes and seeds, reporting time, absolute error, width of
+# the bootstrap confidence interval and how often it covers the full loss.
+#
+#   python -m benchmarks.fast_validation --data data/bnc_data --checkpoint model.pt
+###############################################################################
+
+import argparse
+import json
+import time
+import numpy as np
+import torch
+
+import data
+from model import RNNModel
+from validation import SubsampledValidation
+from utils import batchify
+
+parser = argparse.ArgumentParser(description='Benchmark subsampled validation')
+parser.add_argument('--data', type=str, default='data/bnc_data')
+parser.add_argument('--checkpoint', type=str, default='',
+                    help='model saved by main.py, a randomly initialized model is used if empty')
+parser.add_argument('--emsize', type=int, default=50)
+parser.add_argument('--nhid', type=int, default=50)
+parser.add_argument('--reinit_h', action='store_true',
+                    help='sample sentences instead of segments')
+parser.add_argument('--bptt', type=int, default=70,
+                    help='segment length without --reinit_h')
+parser.add_argument('--sizes', nargs='+', type=int, default=[10, 20, 50, 100])
+parser.add_argument('--seeds', type=int, default=10)
+parser.add_argument('--cuda', action='store_true')
+parser.add_argument('--json', type=str, default='',
+                    help='write the results to this file')
+args = parser.parse_args()
+
+corpus = data.Corpus(args.data)
+eos_tokens = corpus.reset_idxs if args.reinit_h else None
+val_data = batchify(corpus.valid, 1, args)
+
+if args.checkpoint:
+    with open(args.checkpoint, 'rb') as f:
+        model = torch.load(f, weights_only=False)[0]
+else:
+    torch.manual_seed(1111)
+    model = RNNModel(len(corpus.dictionary), args.emsize, args.nhid, 0., 0., 0., 0., 0., temperature=-1,
+                     frequencies=corpus.frequencies)
+model = model.cuda() if args.cuda else model.cpu()
+model.eval()
+
+start = time.time()
+full_loss, _ = model.evaluate(val_data, eos_tokens)
+full_time = time.time() - start
+print('| full validation | {:7d} tokens | loss {:6.3f} | {:7.2f}s'.format(val_data.size(0), full_loss, full_time))
+
+results = {'full': {'loss': full_loss, 'time': full_time, 'tokens': val_data.size(0)}, 'subsampled': []}
+for size in args.sizes:
+    times, errors, widths, covered, fractions = [], [], [], [], []
+    for seed in range(args.seeds):
+        fast_val = SubsampledValidation(val_data, size, eos_tokens, args.bptt, seed)
+        start = time.time()
+        estimate, (low, high) = fast_val.evaluate(model, eos_tokens)
+        times.append(time.time() - start)
+        errors.append(abs(estimate - full_loss))
+        widths.append(high - low)
+        covered.append(low <= full_loss <= high)
+        fractions.append(fast_val.fraction)
+    result = {'units': size, 'fraction': np.mean(fractions), 'time': np.mean(times), 'speedup': full_time / np.mean(times),
+              'abs_error': np.mean(errors), 'ci_width': np.mean(widths), 'coverage': np.mean(covered)}
+    results['subsampled'].append(result)
+    print('| {units:5d} units | {fraction:6.1%} of tokens | {time:7.2f}s | speedup {speedup:6.1f}x | '
+          'abs error {abs_error:6.3f} | ci width {ci_width:6.3f} | coverage {coverage:4.0%}'.format(**result))
+
+if args.json:
+    with open(args.json, 'w') as f:
+        json.dump(results, f, indent=1)
@@ -0,0 +1,190 @@
+###############################################################################
+# Microbenchmarks of the building blocks of the model
+#
+# Times every dist_fn (distance.py, hb_helpers.py), the NegativeSampler,
+# embedded_dropout, WeightDrop, one RNNModel forward/backward step and
+# RNNModel.evaluate per token over a grid of vocabulary sizes, nhid and batch
+# sizes. Every case is seeded, the results are written as json so that runs
+# of different commits can be compared with --compare.
+#
+#   python -m benchmarks.microbench --vocab 1000 10000 --nhid 50 200 --json bench.json
+#   python -m benchmarks.microbench --json new.json --compare bench.json
+###############################################################################
+
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import time
+import numpy as np
+import torch
+
+from distance import eucl_distance, dot_distance, cone_distance
+from hb_helpers import pairwise_poinc_distance
+from embed_regularize import embedded_dropout
+from weight_drop import WeightDrop
+from sample import NegativeSampler
+from model import RNNModel
+
+parser = argparse.ArgumentParser(description='Microbenchmarks of distances, sampler, forward and evaluate')
+parser.add_argument('--vocab', nargs='+', type=int, default=[1000, 10000])
+parser.add_argument('--nhid', nargs='+', type=int, default=[50, 200])
+parser.add_argument('--batch_size', nargs='+', type=int, default=[20, 80])
+parser.add_argument('--bptt', type=int, default=70)
+parser.add_argument('--nsamples', type=int, default=10)
+parser.add_argument('--eval_tokens', type=int, default=200,
+                    help='number of tokens scored per call of evaluate')
+parser.add_argument('--repeats', type=int, default=5)
+parser.add_argument('--min_time', type=float, default=0.05,
+                    help='every repeat calls a case as often as needed to take at least this long (seconds)')
+parser.add_argument('--seed', type=int, default=1111)
+parser.add_argument('--threads', type=int, default=0,
+                    help='number of torch threads (0 = torch default)')
+parser.add_argument('--only', nargs='+', type=str, default=None,
+                    help='only run the cases whose name starts with one of these')
+parser.add_argument('--json', type=str, default='',
+                    help='write the results to this file')
+parser.add_argument('--compare', type=str, default='',
+                    help='json file of an earlier run, prints the ratio of the times')
+
+DISTANCES = {'eucl': eucl_distance, 'dot': dot_distance, 'cone': cone_distance, 'poinc': pairwise_poinc_distance}
+
+def zipf_frequencies(ntoken):
+    return 1. / torch.arange(1, ntoken + 1, dtype=torch.float)
+
+def make_model(ntoken, nhid, nsamples):
+    return RNNModel(ntoken, nhid, nhid, 0., 0., 0., 0., 0., nsamples=nsamples, temperature=-1,
+                    frequencies=zipf_frequencies(ntoken))
+
+# every case depends on some of vocab, nhid and batch_size and returns the function that is timed
+
+def distance_pairs(dist_fn):
+    # n hiddens against n hiddens, as for the positive and negative samples of forward
+    def case(vocab, nhid, batch_size, args):
+        x, y, bias = torch.randn(batch_size * args.bptt, nhid), torch.randn(batch_size * args.bptt, nhid), torch.randn(batch_size * args.bptt)
+        return lambda: dist_fn(x, y, bias)
+    return case
+
+def distance_all(dist_fn):
+    # one hidden against the outputs of all words, as for every position of evaluate
+    def case(vocab, nhid, batch_size, args):
+        x, y, bias = torch.randn(1, nhid), torch.randn(vocab, nhid), torch.randn(vocab)
+        return lambda: dist_fn(x, y, bias)
+    return case
+
+def sampler(vocab, nhid, batch_size, args):
+    negative_sampler = NegativeSampler(args.nsamples, zipf_frequencies(vocab))
+    return lambda: negative_sampler(batch_size, args.bptt, cuda=False)
+
+def embedding_dropout(vocab, nhid, batch_size, args):
+    embed, words = torch.nn.Embedding(vocab, nhid), torch.randint(0, vocab, (args.bptt, batch_size))
+    return lambda: embedded_dropout(embed, words, dropout=0.1)
+
+def weight_drop(vocab, nhid, batch_size, args):
+    rnn = WeightDrop(torch.nn.RNN(nhid, nhid), ['weight_hh_l0'], dropout=0.5)
+    x = torch.randn(args.bptt, batch_size, nhid)
+    return lambda: rnn(x)
+
+def forward_backward(vocab, nhid, batch_size, args):
+    model = make_model(vocab, nhid, args.nsamples)
+    model.train()
+    data, hidden = torch.randint(0, vocab, (args.bptt, batch_size)), model.init_hidden(batch_size)
+    def step():
+        model.zero_grad()
+        loss, _ = model(data, hidden)
+        loss.backward()
+    return step
+
+def evaluate(vocab, nhid, batch_size, args):
+    model = make_model(vocab, nhid, args.nsamples)
+    model.eval()
+    data = torch.randint(0, vocab, (args.eval_tokens, 1))
+    def score():
+        with torch.no_grad():
+            model.evaluate(data)
+    return score
+
+# (name, case, the grid dimensions the case depends on)
+CASES = [('distance_pairs.' + name, distance_pairs(fn), ('nhid', 'batch_size')) for name, fn in DISTANCES.items()]
+CASES += [('distance_all.' + name, distance_all(fn), ('vocab', 'nhid')) for name, fn in DISTANCES.items()]
+CASES += [('sampler', sampler, ('vocab', 'batch_size')),
+          ('embedded_dropout', embedding_dropout, ('vocab', 'nhid', 'batch_size')),
+          ('weight_drop', weight_drop, ('nhid', 'batch_size')),
+          ('forward_backward', forward_backward, ('vocab', 'nhid', 'batch_size')),
+          ('evaluate', evaluate, ('vocab', 'nhid'))]
+
+def measure(fn, repeats, min_time):
+    # calls fn often enough that a repeat takes at least min_time, returns the seconds per call of every repeat
+    fn()
+    number, start = 1, time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    if elapsed < min_time:
+        number = int(np.ceil(min_time / max(elapsed, 1e-7)))
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return times, number
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def key(result):
+    return (result['name'], result.get('vocab'), result.get('nhid'), result.get('batch_size'))
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    results = []
+    for name, case, dims in CASES:
+        if args.only is not None and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        if name.endswith('poinc') and not torch.cuda.is_available():
+            # pairwise_poinc_distance allocates its output on the gpu
+            print('| {:24s} | skipped, needs cuda'.format(name))
+            continue
+
+        # the grid restricted to the dimensions the case depends on
+        grid = {'vocab': args.vocab, 'nhid': args.nhid, 'batch_size': args.batch_size}
+        for values in itertools.product(*[grid[dim] for dim in dims]):
+            setting = dict(zip(dims, values))
+            torch.manual_seed(args.seed)
+            np.random.seed(args.seed)
+            fn = case(setting.get('vocab'), setting.get('nhid'), setting.get('batch_size'), args)
+            times, number = measure(fn, args.repeats, args.min_time)
+
+            result = dict(name=name, ms=1000 * float(np.median(times)), min_ms=1000 * min(times), calls=number, **setting)
+            if name == 'evaluate':
+                result['ms_per_token'] = result['ms'] / args.eval_tokens
+            results.append(result)
+            print('| {:24s} | {:40s} | {:10.4f} ms | min {:10.4f} ms'.format(
+                name, ' '.join('{} {}'.format(dim, value) for dim, value in setting.items()), result['ms'], result['min_ms']))
+
+    if args.compare:
+        with open(args.compare) as f:
+            earlier = json.load(f)
+        previous = {key(r): r for r in earlier['results']}
+        print('| comparison with {} (commit {})'.format(args.compare, earlier['meta']['commit']))
+        for result in results:
+            if key(result) in previous:
+                ratio = result['ms'] / previous[key(result)]['ms']
+                print('| {:24s} | {:40s} | {:10.4f} ms -> {:10.4f} ms | {:5.2f}x'.format(
+                    result['name'], ' '.join(str(v) for v in key(result)[1:] if v is not None),
+                    previous[key(result)]['ms'], result['ms'], ratio))
+
+    if args.json:
+        meta = {'commit': commit(), 'torch': torch.__version__, 'python': platform.python_version(),
+                'machine': platform.machine(), 'threads': torch.get_num_threads(), 'time': time.time(),
+                'args': vars(args)}
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
@@ -0,0 +1,76 @@
+###############################################################################
+# Bias and variance of the importance-sampled validation loss
+# (RNNModel.evaluate_sampled, main.py --sampled_valid) against RNNModel.evaluate
+#
+#   python -m benchmarks.partition_estimate --data data/bnc_data --checkpoint model.pt
+###############################################################################
+
+import argparse
+import json
+import time
+import numpy as np
+import torch
+
+import data
+from model import RNNModel
+from utils import batchify
+
+parser = argparse.ArgumentParser(description='Benchmark the importance-sampled partition function estimator')
+parser.add_argument('--data', type=str, default='data/bnc_data')
+parser.add_argument('--checkpoint', type=str, default='',
+                    help='model saved by main.py, a randomly initialized model is used if empty')
+parser.add_argument('--emsize', type=int, default=50)
+parser.add_argument('--nhid', type=int, default=50)
+parser.add_argument('--reinit_h', action='store_true')
+parser.add_argument('--ntokens', type=int, default=0,
+                    help='only use the first ntokens of the validation data (0 = all)')
+parser.add_argument('--nsamples', nargs='+', type=int, default=[1, 10, 50, 100, 500])
+parser.add_argument('--repeats', type=int, default=10)
+parser.add_argument('--cuda', action='store_true')
+parser.add_argument('--json', type=str, default='',
+                    help='write the results to this file')
+args = parser.parse_args()
+
+corpus = data.Corpus(args.data)
+eos_tokens = corpus.reset_idxs if args.reinit_h else None
+val_data = batchify(corpus.valid[:args.ntokens] if args.ntokens else corpus.valid, 1, args)
+
+if args.checkpoint:
+    with open(args.checkpoint, 'rb') as f:
+        model = torch.load(f, weights_only=False)[0]
+else:
+    torch.manual_seed(1111)
+    model = RNNModel(len(corpus.dictionary), args.emsize, args.nhid, 0., 0., 0., 0., 0., temperature=-1,
+                     frequencies=corpus.frequencies)
+model = model.cuda() if args.cuda else model.cpu()
+model.eval()
+
+start = time.time()
+exact_loss, exact_entropy = model.evaluate(val_data, eos_tokens)
+exact_time = time.time() - start
+print('| exact | {:7d} tokens | {:6d} words | loss {:6.3f} | {:7.2f}s'.format(
+    val_data.size(0), model.ntoken, exact_loss, exact_time))
+
+# the last chunk holds a single position
+_, entropy = model.evaluate_sampled(val_data, eos_tokens, 10, chunk_size=val_data.size(0) - 1)
+assert entropy.shape == exact_entropy.shape and np.isfinite(entropy).all()
+
+results = {'exact': {'loss': exact_loss, 'time': exact_time, 'tokens': val_data.size(0)}, 'sampled': []}
+for k in args.nsamples:
+    losses, times = [], []
+    for seed in range(args.repeats):
+        torch.manual_seed(seed)
+        start = time.time()
+        loss, entropy = model.evaluate_sampled(val_data, eos_tokens, k)
+        times.append(time.time() - start)
+        losses.append(float(loss))
+    losses = np.array(losses)
+    result = {'nsamples': k, 'time': np.mean(times), 'speedup': exact_time / np.mean(times),
+              'bias': losses.mean() - exact_loss, 'variance': losses.var(), 'token_corr': np.corrcoef(entropy, exact_entropy)[0, 1]}
+    results['sampled'].append(result)
+    print('| k = {nsamples:5d} | {time:7.2f}s | speedup {speedup:6.1f}x | bias {bias:+8.4f} | '
+          'variance {variance:9.2e} | per token correlation {token_corr:5.3f}'.format(**result))
+
+if args.json:
+    with open(args.json, 'w') as f:
+        json.dump(results, f, indent=1)
@@ -0,0 +1,145 @@
+###############################################################################
+# End-to-end scaling on synthetic Zipfian corpora
+#
+# For every vocabulary size and corpus size a corpus is generated (or reused)
+# with benchmarks.synthetic_corpus, then a fresh process loads it with
+# data.Corpus, trains the model for one epoch and evaluates it. The time and
+# the peak resident memory after every phase are reported, scales that fail
+# or exceed --timeout are reported as such.
+#
+#   python -m benchmarks.scaling --vocab 1000 10000 100000 1000000 --ntokens 100000 1000000 --json scaling.json
+###############################################################################
+
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import torch
+
+import data
+from model import RNNModel
+from utils import batchify, get_batch, repackage_hidden, memory_usage
+from benchmarks.synthetic_corpus import write_corpus, LENGTHS
+
+parser = argparse.ArgumentParser(description='Scaling of corpus loading, training and evaluation on synthetic corpora')
+parser.add_argument('--vocab', nargs='+', type=int, default=[1000, 10000, 100000])
+parser.add_argument('--ntokens', nargs='+', type=int, default=[100000, 1000000])
+parser.add_argument('--corpora', type=str, default='synthetic',
+                    help='directory the corpora are generated in, existing corpora are reused')
+parser.add_argument('--lengths', type=str, default='geometric', choices=LENGTHS)
+parser.add_argument('--mean_length', type=float, default=20.)
+parser.add_argument('--zipf', type=float, default=1.)
+parser.add_argument('--emsize', type=int, default=50)
+parser.add_argument('--nhid', type=int, default=50)
+parser.add_argument('--batch_size', type=int, default=20)
+parser.add_argument('--bptt', type=int, default=70)
+parser.add_argument('--nsamples', type=int, default=10)
+parser.add_argument('--max_batches', type=int, default=0,
+                    help='stop the training epoch after this many batches (0 = full epoch)')
+parser.add_argument('--eval_tokens', type=int, default=1000,
+                    help='number of validation tokens scored, evaluate costs O(vocab) per token (0 = all)')
+parser.add_argument('--timeout', type=float, default=3600.,
+                    help='seconds after which a scale is stopped')
+parser.add_argument('--seed', type=int, default=1111)
+parser.add_argument('--json', type=str, default='',
+                    help='write the results to this file')
+parser.add_argument('--child', type=str, default='',
+                    help=argparse.SUPPRESS)
+
+def peak_rss():
+    # peak resident memory of this process in MB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def run_scale(path, args):
+    """Loads the corpus at path, trains one epoch and evaluates, returns time and peak rss per phase."""
+    args.cuda = False
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    result = {'start_rss': peak_rss()}
+
+    start = time.time()
+    corpus = data.Corpus(path)
+    result['load'] = {'time': time.time() - start, 'peak_rss': peak_rss(), 'rss': memory_usage()[0]}
+    result['vocab_seen'] = len(corpus.dictionary)
+
+    start = time.time()
+    train_data = batchify(corpus.train, args.batch_size, args)
+    model = RNNModel(len(corpus.dictionary), args.emsize, args.nhid, 0., 0., 0., 0., 0., nsamples=args.nsamples,
+                     temperature=-1, frequencies=corpus.frequencies)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1.)
+    model.train()
+    hidden, batches, i = model.init_hidden(args.batch_size), 0, 0
+    while i < train_data.size(0) - 1 and (args.max_batches == 0 or batches < args.max_batches):
+        data_batch = get_batch(train_data, i, args, seq_len=args.bptt)
+        hidden = repackage_hidden(hidden)
+        optimizer.zero_grad()
+        loss, hidden = model(data_batch, hidden)
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
+        optimizer.step()
+        i, batches = i + args.bptt + 1, batches + 1
+    elapsed = time.time() - start
+    result['train'] = {'time': elapsed, 'peak_rss': peak_rss(), 'rss': memory_usage()[0], 'batches': batches,
+                       'tokens_per_second': batches * args.bptt * args.batch_size / elapsed, 'loss': loss.item()}
+
+    start = time.time()
+    val_data = batchify(corpus.valid[:args.eval_tokens] if args.eval_tokens else corpus.valid, 1, args)
+    model.eval()
+    with torch.no_grad():
+        val_loss, _ = model.evaluate(val_data, corpus.reset_idxs)
+    elapsed = time.time() - start
+    result['evaluate'] = {'time': elapsed, 'peak_rss': peak_rss(), 'rss': memory_usage()[0], 'tokens': val_data.size(0),
+                          'ms_per_token': 1000 * elapsed / val_data.size(0), 'loss': float(val_loss)}
+    return result
+
+def child_arguments(args):
+    forwarded = ['emsize', 'nhid', 'batch_size', 'bptt', 'nsamples', 'max_batches', 'eval_tokens', 'seed']
+    return list(itertools.chain(*[['--' + name, str(getattr(args, name))] for name in forwarded]))
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    if args.child:
+        # one scale in a fresh process, so that the peak rss is not inherited from earlier scales
+        print(json.dumps(run_scale(args.child, args)))
+        sys.exit(0)
+
+    results = []
+    for vocab, ntokens in itertools.product(args.vocab, args.ntokens):
+        path = os.path.join(args.corpora, 'zipf-{}-{}-{}-{}-{}'.format(vocab, ntokens, args.lengths, args.mean_length, args.seed))
+        if not os.path.exists(os.path.join(path, 'test.txt')):
+            start = time.time()
+            write_corpus(path, vocab, ntokens, zipf=args.zipf, lengths=args.lengths, mean_length=args.mean_length, seed=args.seed)
+            print('| generated {} in {:6.1f}s'.format(path, time.time() - start))
+
+        result = {'vocab': vocab, 'ntokens': ntokens, 'corpus': path}
+        try:
+            process = subprocess.run([sys.executable, '-m', 'benchmarks.scaling', '--child', path] + child_arguments(args),
+                                     stdout=subprocess.PIPE, timeout=args.timeout)
+            if process.returncode == 0:
+                result.update(json.loads(process.stdout.decode().strip().split('\n')[-1]))
+                result['status'] = 'ok'
+            else:
+                # e.g. -9 if the process was killed for running out of memory
+                result['status'] = 'failed ({})'.format(process.returncode)
+        except subprocess.TimeoutExpired:
+            result['status'] = 'timeout'
+        results.append(result)
+
+        if result['status'] == 'ok':
+            print('| vocab {:8d} | tokens {:10d} | load {:7.2f}s {:8.1f} MB | train {:8.2f}s {:8.1f} MB {:8.0f} tok/s | '
+                  'evaluate {:7.2f} ms/token {:8.1f} MB'.format(vocab, ntokens, result['load']['time'], result['load']['peak_rss'],
+                  result['train']['time'], result['train']['peak_rss'], result['train']['tokens_per_second'],
+                  result['evaluate']['ms_per_token'], result['evaluate']['peak_rss']))
+        else:
+            print('| vocab {:8d} | tokens {:10d} | {}'.format(vocab, ntokens, result['status']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=1)
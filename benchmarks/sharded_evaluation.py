@@ -0,0 +1,72 @@
+###############################################################################
+# Wall-clock scaling of sentence-sharded evaluation (main.py --eval_workers)
+#
+# Scores the validation data serially and with pools of increasing size and
+# checks that the merged per-token entropy equals the serial one.
+#
+#   python -m benchmarks.sharded_evaluation --data data/bnc_data --workers 1 2 4 8
+###############################################################################
+
+import argparse
+import json
+import time
+import numpy as np
+import torch
+
+import data
+from model import RNNModel
+from utils import batchify
+from validation import evaluate_sharded, init_shard_worker
+
+parser = argparse.ArgumentParser(description='Benchmark sentence-sharded evaluation')
+parser.add_argument('--data', type=str, default='data/bnc_data')
+parser.add_argument('--checkpoint', type=str, default='',
+                    help='model saved by main.py, a randomly initialized model is used if empty')
+parser.add_argument('--emsize', type=int, default=50)
+parser.add_argument('--nhid', type=int, default=50)
+parser.add_argument('--ntokens', type=int, default=0,
+                    help='only use the first ntokens of the validation data (0 = all)')
+parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4])
+parser.add_argument('--json', type=str, default='',
+                    help='write the results to this file')
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    args.cuda = False
+
+    corpus = data.Corpus(args.data)
+    eos_tokens = corpus.reset_idxs
+    val_data = batchify(corpus.valid[:args.ntokens] if args.ntokens else corpus.valid, 1, args)
+
+    if args.checkpoint:
+        with open(args.checkpoint, 'rb') as f:
+            model = torch.load(f, weights_only=False)[0].cpu()
+    else:
+        torch.manual_seed(1111)
+        model = RNNModel(len(corpus.dictionary), args.emsize, args.nhid, 0., 0., 0., 0., 0., temperature=-1,
+                         frequencies=corpus.frequencies)
+    model.eval()
+
+    start = time.time()
+    serial_loss, serial_entropy = model.evaluate(val_data, eos_tokens)
+    serial_time = time.time() - start
+    print('| serial | {:7d} tokens | loss {:6.3f} | {:7.2f}s'.format(val_data.size(0), serial_loss, serial_time))
+
+    results = {'serial': {'loss': serial_loss, 'time': serial_time, 'tokens': val_data.size(0)}, 'sharded': []}
+    for workers in args.workers:
+        threads = max(1, torch.get_num_threads() // workers)
+        with torch.multiprocessing.get_context('spawn').Pool(workers, init_shard_worker, (threads,)) as pool:
+            # warm up, the workers import torch and the model code on their first task
+            evaluate_sharded(model, val_data[:100], eos_tokens, pool, workers)
+            start = time.time()
+            loss, entropy = evaluate_sharded(model, val_data, eos_tokens, pool, 4 * workers)
+            elapsed = time.time() - start
+        result = {'workers': workers, 'time': elapsed, 'speedup': serial_time / elapsed,
+                  'max_abs_diff': float(np.abs(entropy - serial_entropy).max())}
+        results['sharded'].append(result)
+        print('| {workers:3d} workers | {time:7.2f}s | speedup {speedup:5.2f}x | max entropy difference {max_abs_diff:.2e}'.format(**result))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
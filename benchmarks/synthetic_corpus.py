@@ -0,0 +1,78 @@
+###############################################################################
+# Synthetic corpora with a Zipfian vocabulary
+#
+# Writes train.txt, valid.txt and test.txt in the format read by data.Corpus.
+# Word w<r> has rank r and is drawn with probability proportional to 1/r^s,
+# sentence lengths follow a configurable distribution with the given mean.
+#
+#   python -m benchmarks.synthetic_corpus --out /tmp/zipf-10k --vocab 10000 --ntokens 1000000
+###############################################################################
+
+import argparse
+import os
+import numpy as np
+
+LENGTHS = ['geometric', 'poisson', 'lognormal', 'fixed']
+
+parser = argparse.ArgumentParser(description='Write a synthetic corpus with a Zipfian vocabulary')
+parser.add_argument('--out', type=str, required=True,
+                    help='directory the corpus is written to')
+parser.add_argument('--vocab', type=int, default=10000,
+                    help='number of distinct words that can be drawn')
+parser.add_argument('--ntokens', type=int, default=1000000,
+                    help='number of training tokens (including <eos>)')
+parser.add_argument('--valid_fraction', type=float, default=0.05,
+                    help='size of the validation and test data relative to the training data')
+parser.add_argument('--zipf', type=float, default=1.,
+                    help='exponent s of the Zipf distribution')
+parser.add_argument('--lengths', type=str, default='geometric', choices=LENGTHS,
+                    help='distribution of the sentence lengths')
+parser.add_argument('--mean_length', type=float, default=20.,
+                    help='mean sentence length (without <eos>)')
+parser.add_argument('--seed', type=int, default=1111)
+
+def zipf_probabilities(vocab, s=1.):
+    p = 1. / np.arange(1, vocab + 1, dtype=np.float64) ** s
+    return p / p.sum()
+
+def sentence_lengths(rng, n, distribution='geometric', mean=20.):
+    # n sentence lengths >= 1 with (approximately) the given mean
+    if distribution == 'geometric':
+        lengths = rng.geometric(1. / mean, n)
+    elif distribution == 'poisson':
+        lengths = rng.poisson(mean - 1, n) + 1
+    elif distribution == 'lognormal':
+        # sigma 0.5, mu chosen such that the mean is as given
+        lengths = np.round(rng.lognormal(np.log(mean) - 0.125, 0.5, n))
+    else:
+        lengths = np.full(n, int(round(mean)))
+    return np.maximum(lengths, 1).astype(np.int64)
+
+def write_split(path, rng, cdf, ntokens, distribution, mean_length, chunk=100000):
+    # sentences are drawn until ntokens tokens (each sentence plus its <eos>) are written
+    written = 0
+    with open(path + '.tmp', 'w') as f:
+        while written < ntokens:
+            lengths = sentence_lengths(rng, chunk, distribution, mean_length)
+            lengths = lengths[:np.searchsorted(np.cumsum(lengths + 1), ntokens - written) + 1]
+            words = np.searchsorted(cdf, rng.random(int(lengths.sum())), side='right')
+            words = np.minimum(words, len(cdf) - 1)
+            for sentence in np.split(words, np.cumsum(lengths)[:-1]):
+                f.write(' '.join('w' + str(w) for w in sentence.tolist()) + '\n')
+            written += int((lengths + 1).sum())
+    os.replace(path + '.tmp', path)
+    return written
+
+def write_corpus(out, vocab, ntokens, valid_fraction=0.05, zipf=1., lengths='geometric', mean_length=20., seed=1111):
+    """Writes {train,valid,test}.txt to out and returns the number of tokens of every split."""
+    os.makedirs(out, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    cdf = np.cumsum(zipf_probabilities(vocab, zipf))
+    sizes = {'train': ntokens, 'valid': max(1, int(valid_fraction * ntokens)), 'test': max(1, int(valid_fraction * ntokens))}
+    return {split: write_split(os.path.join(out, split + '.txt'), rng, cdf, n, lengths, mean_length) for split, n in sizes.items()}
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    ntokens = write_corpus(args.out, args.vocab, args.ntokens, args.valid_fraction, args.zipf, args.lengths, args.mean_length, args.seed)
+    print('| {} | vocab {} | '.format(args.out, args.vocab) + ' | '.join('{} {} tokens'.format(k, v) for k, v in ntokens.items()))
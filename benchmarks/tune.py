@@ -0,0 +1,143 @@
+###############################################################################
+# Batch size, bptt and nsamples under a memory budget
+#
+# Every candidate setting is probed in a fresh process with a few training
+# steps (forward, backward, clipping and an optimizer step) of random batches
+# drawn from the unigram distribution of the corpus. The throughput is taken
+# at seq_len = bptt, the peak memory at the longest seq_len main.py draws with
+# reasonable probability (seq_len ~ N(bptt, 5), so bptt + 5 * --jitter). The
+# fastest setting whose peak fits into --memory is recommended.
+#
+#   python -m benchmarks.tune --data data/penn --memory 4000 --batch_size 20 40 80 --bptt 35 70 --nsamples 10 20
+###############################################################################
+
+import argparse
+import itertools
+import json
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import torch
+
+import data
+from model import RNNModel
+
+parser = argparse.ArgumentParser(description='Recommend batch size, bptt and nsamples for a memory budget')
+parser.add_argument('--data', type=str, default='data/bnc_data')
+parser.add_argument('--memory', type=float, required=True,
+                    help='memory budget in MB (peak resident memory, or peak allocated gpu memory with --cuda)')
+parser.add_argument('--batch_size', nargs='+', type=int, default=[20, 40, 80])
+parser.add_argument('--bptt', nargs='+', type=int, default=[35, 70])
+parser.add_argument('--nsamples', nargs='+', type=int, default=[10])
+parser.add_argument('--emsize', type=int, default=400)
+parser.add_argument('--nhid', type=int, default=1150)
+parser.add_argument('--dist_fn', type=str, default='eucl')
+parser.add_argument('--dropout', type=float, default=0.,
+                    help='dropout of the inputs, hidden states and outputs (as main.py --dropout, --dropouth, --dropouti)')
+parser.add_argument('--wdrop', type=float, default=0.)
+parser.add_argument('--steps', type=int, default=5,
+                    help='number of timed training steps per candidate (after one warm-up step)')
+parser.add_argument('--jitter', type=float, default=3.,
+                    help='headroom for the seq_len jitter of main.py in standard deviations (5 tokens each)')
+parser.add_argument('--timeout', type=float, default=600.,
+                    help='seconds after which a candidate is given up')
+parser.add_argument('--cuda', action='store_true')
+parser.add_argument('--seed', type=int, default=1111)
+parser.add_argument('--json', type=str, default='',
+                    help='write the results to this file')
+parser.add_argument('--child', type=int, nargs=3, default=None,
+                    help=argparse.SUPPRESS)
+
+def peak_memory(cuda):
+    # peak resident memory of this process in MB, or peak allocated gpu memory
+    if cuda:
+        return torch.cuda.max_memory_allocated() / 1024.**2
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def probe(batch_size, bptt, nsamples, args):
+    """Times args.steps training steps at seq_len = bptt and returns the throughput and the peak memory
+    including one step at the longest jittered seq_len."""
+    cuda = args.cuda and torch.cuda.is_available()
+    torch.manual_seed(args.seed)
+    corpus = data.Corpus(args.data)
+    model = RNNModel(len(corpus.dictionary), args.emsize, args.nhid, args.dropout, args.dropout, args.dropout, 0., args.wdrop,
+                     nsamples=nsamples, temperature=-1, frequencies=corpus.frequencies, dist_fn=args.dist_fn)
+    if cuda: model = model.cuda()
+    params = list(model.parameters())
+    optimizer = torch.optim.SGD(params, lr=1.)
+    model.train()
+
+    def step(seq_len):
+        # the corpus itself may be too small for seq_len x batch_size, so the batch is sampled
+        batch = torch.multinomial(corpus.frequencies, (seq_len + 1) * batch_size, replacement=True).view(seq_len + 1, batch_size)
+        hidden = model.init_hidden(batch_size)
+        if cuda: batch = batch.cuda()
+        optimizer.zero_grad()
+        loss, _ = model(batch, hidden)
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(params, 0.25)
+        optimizer.step()
+        if cuda: torch.cuda.synchronize()
+
+    step(bptt)
+    start = time.time()
+    for _ in range(args.steps):
+        step(bptt)
+    elapsed = time.time() - start
+    peak = peak_memory(cuda)
+
+    max_seq_len = int(np.ceil(bptt + 5 * args.jitter))
+    step(max_seq_len)
+    return {'tokens_per_second': args.steps * bptt * batch_size / elapsed, 'ms_per_batch': 1000 * elapsed / args.steps,
+            'peak_memory': peak, 'max_seq_len': max_seq_len, 'peak_memory_max_seq_len': peak_memory(cuda)}
+
+def child_arguments(args):
+    forwarded = ['data', 'memory', 'emsize', 'nhid', 'dist_fn', 'dropout', 'wdrop', 'steps', 'jitter', 'seed']
+    return list(itertools.chain(*[['--' + name, str(getattr(args, name))] for name in forwarded])) + (['--cuda'] if args.cuda else [])
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    if args.child is not None:
+        # one candidate per process, so that the peak memory is not inherited from earlier candidates
+        print(json.dumps(probe(*args.child, args)))
+        sys.exit(0)
+
+    results = []
+    for batch_size, bptt, nsamples in itertools.product(args.batch_size, args.bptt, args.nsamples):
+        result = {'batch_size': batch_size, 'bptt': bptt, 'nsamples': nsamples}
+        try:
+            process = subprocess.run([sys.executable, '-m', 'benchmarks.tune', '--child', str(batch_size), str(bptt), str(nsamples)]
+                                     + child_arguments(args), stdout=subprocess.PIPE, timeout=args.timeout)
+            if process.returncode == 0:
+                result.update(json.loads(process.stdout.decode().strip().split('\n')[-1]))
+                result['fits'] = result['peak_memory_max_seq_len'] <= args.memory
+            else:
+                # e.g. -9 if the process was killed for running out of memory
+                result['fits'], result['status'] = False, 'failed ({})'.format(process.returncode)
+        except subprocess.TimeoutExpired:
+            result['fits'], result['status'] = False, 'timeout'
+        results.append(result)
+
+        if 'status' in result:
+            print('| batch_size {:4d} | bptt {:4d} | nsamples {:4d} | {}'.format(batch_size, bptt, nsamples, result['status']))
+        else:
+            print('| batch_size {:4d} | bptt {:4d} | nsamples {:4d} | {:8.0f} tok/s | {:8.1f} ms/batch | peak {:8.1f} MB | '
+                  'peak at seq_len {:4d} {:8.1f} MB | {}'.format(batch_size, bptt, nsamples, result['tokens_per_second'],
+                  result['ms_per_batch'], result['peak_memory'], result['max_seq_len'], result['peak_memory_max_seq_len'],
+                  'fits' if result['fits'] else 'exceeds {:.0f} MB'.format(args.memory)))
+
+    fitting = [r for r in results if r['fits']]
+    best = max(fitting, key=lambda r: r['tokens_per_second']) if fitting else None
+    if best is None:
+        print('| no setting fits into {:.0f} MB'.format(args.memory))
+    else:
+        print('| recommended: --batch_size {batch_size} --bptt {bptt} --nsamples {nsamples} '
+              '({tokens_per_second:.0f} tok/s, peak {peak_memory_max_seq_len:.1f} MB)'.format(**best))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results, 'recommended': best}, f, indent=1)
@@ -0,0 +1,73 @@
+import os
+import time
+import queue
+import threading
+
+import torch
+
+
+def to_cpu(obj):
+    # copies all tensors of a (nested) state_dict into cpu buffers
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+class AsyncCheckpointer(object):
+    """Writes checkpoints from a background thread.
+
+    save() only copies the state into cpu buffers, the time this blocks the caller is recorded as
+    the stall. The file is written to fn + '.tmp' and renamed, so fn is always a complete checkpoint.
+    With keep > 0 the previous versions of fn are retained as fn.1 (newest) up to fn.<keep>."""
+
+    def __init__(self, keep=0):
+        self.keep = keep
+        self.stalls, self.writes = [], []
+        self.error = None
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def save(self, fn, state):
+        if self.error is not None:
+            raise self.error
+        start_time = time.time()
+        self.jobs.put((fn, to_cpu(state)))
+        self.stalls.append(time.time() - start_time)
+
+    def work(self):
+        while True:
+            fn, state = self.jobs.get()
+            try:
+                start_time = time.time()
+                torch.save(state, fn + '.tmp')
+                self.rotate(fn)
+                os.replace(fn + '.tmp', fn)
+                self.writes.append(time.time() - start_time)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def rotate(self, fn):
+        # fn.k -> fn.k+1, the oldest version falls off the end
+        if self.keep == 0 or not os.path.exists(fn):
+            return
+        for k in reversed(range(1, self.keep)):
+            if os.path.exists('{}.{}'.format(fn, k)):
+                os.replace('{}.{}'.format(fn, k), '{}.{}'.format(fn, k + 1))
+        os.replace(fn, fn + '.1')
+
+    def wait(self):
+        # blocks until every pending checkpoint is on disk
+        self.jobs.join()
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        n = max(1, len(self.stalls))
+        return {'checkpoints': len(self.stalls), 'mean_stall': 1000 * sum(self.stalls) / n, 'max_stall': 1000 * max(self.stalls or [0]),
+                'mean_write': 1000 * sum(self.writes) / max(1, len(self.writes))}
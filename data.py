@@ -1,5 +1,7 @@
 import os
+import json
 import torch
+import numpy as np
 
 from collections import Counter
 
@@ -30,11 +32,66 @@ class Corpus(object):
         self.nsentences_of_length = None
 
         self.dictionary = Dictionary()
+        if os.path.exists(os.path.join(path, 'tokens.json')):
+            self.load_binary(path)
+            return
+
         self.train = self.tokenize(os.path.join(path, 'train.txt'), True)
         
         self.valid = self.tokenize(os.path.join(path, 'valid.txt'))
         self.test = self.tokenize(os.path.join(path, 'test.txt'))
 
+    def load_binary(self, path):
+        """Memory-maps pre-tokenized {train,valid,test}.bin files described by tokens.json."""
+        with open(os.path.join(path, 'tokens.json'), 'r') as f:
+            meta = json.load(f)
+
+        for word in meta['words']:
+            self.dictionary.word2idx[word] = len(self.dictionary.idx2word)
+            self.dictionary.idx2word.append(word)
+
+        # copy-on-write maps are writeable for torch but never touch the files
+        splits = []
+        for split in ['train', 'valid', 'test']:
+            ids = np.memmap(os.path.join(path, split + '.bin'), dtype=meta['dtype'], mode='c')
+            splits.append(torch.from_numpy(ids))
+        self.train, self.valid, self.test = splits
+
+        # token counts are stored along with the splits or counted once here
+        if os.path.exists(os.path.join(path, 'frequencies.bin')):
+            counts = np.fromfile(os.path.join(path, 'frequencies.bin'), dtype=np.float32)
+        else:
+            counts = sum(np.bincount(ids.numpy(), minlength=len(self.dictionary)) for ids in splits)
+        for token_id, freq in enumerate(counts):
+            self.dictionary.counter[token_id] += int(freq)
+        self.dictionary.total = int(sum(counts))
+
+        self.frequencies = torch.zeros(len(self.dictionary))
+        for (token_id, freq) in self.dictionary.counter.most_common():
+            self.frequencies[token_id] = freq
+
+        for word in self.resets:
+            if word in self.dictionary.word2idx:
+                self.reset_idxs.add(self.dictionary.word2idx[word])
+
+
+    def save_binary(self, path, dtype='int64'):
+        """Writes the corpus in the format read by load_binary, tokens.json is written last."""
+        os.makedirs(path, exist_ok=True)
+        # temporary files are per process, so that concurrent jobs publishing the same corpus do not collide
+        tmp = '.' + str(os.getpid())
+        for split in ['train', 'valid', 'test']:
+            fn = os.path.join(path, split + '.bin')
+            getattr(self, split).numpy().astype(dtype).tofile(fn + tmp)
+            os.replace(fn + tmp, fn)
+        fn = os.path.join(path, 'frequencies.bin')
+        self.frequencies.numpy().astype(np.float32).tofile(fn + tmp)
+        os.replace(fn + tmp, fn)
+
+        ntokens = {split: len(getattr(self, split)) for split in ['train', 'valid', 'test']}
+        with open(os.path.join(path, 'tokens.json' + tmp), 'w') as f:
+            json.dump({'words': self.dictionary.idx2word, 'dtype': dtype, 'ntokens': ntokens}, f)
+        os.replace(os.path.join(path, 'tokens.json' + tmp), os.path.join(path, 'tokens.json'))
 
     def tokenize(self, path, first=True):
         """Tokenizes a text file."""
@@ -3,26 +3,90 @@
 
 import os
 import sys
+import json
 import zipfile
+import resource
 
-if os.path.exists('train.txt'):
+import numpy as np
+
+# the zip member is streamed in chunks of this many bytes
+CHUNK_SIZE = 1 << 20
+
+# newline bytes become <eos> tokens, exactly as data.Corpus treats text lines
+EOS = ord('\n')
+
+num_test_chars = 5000000
+
+if os.path.exists('train.bin'):
     print('Tokenized enwik8 already exists - skipping processing')
     sys.exit()
 
-data = zipfile.ZipFile('enwik8.zip').read('enwik8')
+def read_chunks(archive):
+    with archive.open('enwik8') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield np.frombuffer(chunk, dtype=np.uint8)
 
-print('Length of enwik8: {}'.format(len(data)))
+def peak_memory_mb():
+    # ru_maxrss is reported in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
 
-num_test_chars = 5000000
+archive = zipfile.ZipFile('enwik8.zip')
+length = archive.getinfo('enwik8').file_size
+
+print('Length of enwik8: {}'.format(length))
+
+splits = [('train', 0, length - 2 * num_test_chars),
+          ('valid', length - 2 * num_test_chars, length - num_test_chars),
+          ('test', length - num_test_chars, length)]
+
+# first pass: find the order in which bytes first appear (this is the order in
+# which data.Corpus would have added them to its dictionary) and the last byte
+# of every split, which decides whether a trailing <eos> is appended
+first_seen = np.full(256, np.inf)
+last_bytes, offset = {}, 0
+for chunk in read_chunks(archive):
+    values, index = np.unique(chunk, return_index=True)
+    first_seen[values] = np.minimum(first_seen[values], offset + index)
+    for name, start, end in splits:
+        if offset < end <= offset + len(chunk):
+            last_bytes[name] = chunk[end - offset - 1]
+    offset += len(chunk)
+
+for name, start, end in splits:
+    if last_bytes[name] != EOS:
+        first_seen[EOS] = min(first_seen[EOS], end - 0.5)
+
+order = [int(b) for b in np.argsort(first_seen, kind='stable') if np.isfinite(first_seen[b])]
+words = ['<eos>' if b == EOS else str(b) for b in order]
+dtype = np.uint8 if len(words) <= 256 else np.uint16
+
+# lookup table from raw byte to token id
+lut = np.zeros(256, dtype=dtype)
+lut[order] = np.arange(len(order), dtype=dtype)
+
+# second pass: translate and write every split as a flat binary token array
+files = {name: open(name + '.bin', 'wb') for name, _, _ in splits}
+ntokens = {name: 0 for name, _, _ in splits}
+offset = 0
+for chunk in read_chunks(archive):
+    for name, start, end in splits:
+        lo, hi = max(start, offset) - offset, min(end, offset + len(chunk)) - offset
+        if lo < hi:
+            files[name].write(lut[chunk[lo:hi]].tobytes())
+            ntokens[name] += hi - lo
+    offset += len(chunk)
+
+for name, start, end in splits:
+    if last_bytes[name] != EOS:
+        files[name].write(lut[[EOS]].tobytes())
+        ntokens[name] += 1
+    files[name].close()
+    print('{}.bin will have {} tokens'.format(name, ntokens[name]))
+
+with open('tokens.json', 'w') as f:
+    json.dump({'words': words, 'dtype': np.dtype(dtype).name, 'ntokens': ntokens}, f)
 
-train_data = data[: -2 * num_test_chars]
-valid_data = data[-2 * num_test_chars: -num_test_chars]
-test_data = data[-num_test_chars:]
-
-for fn, part in [('train.txt', train_data), ('valid.txt', valid_data), ('test.txt', test_data)]:
-    print('{} will have {} bytes'.format(fn, len(part)))
-    print('- Tokenizing...')
-    part_str = ' '.join([str(c) if c != ord('\n') else '\n' for c in part])
-    print('- Writing...')
-    f = open(fn, 'w').write(part_str)
-    f = open(fn + '.raw', 'wb').write(part)
+print('Peak memory: {:.1f} MB'.format(peak_memory_mb()))
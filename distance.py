@@ -19,8 +19,10 @@ def dot_distance(x, y, bias=None):
 		the dot product of x with y. 
 	'''
 	sim_fn = torch.nn.functional.linear
-	if x.size(0) > 1:
-		return torch.diag(-sim_fn(x, y, bias=bias))
+	if x.size(0) == y.size(0):
+		# row-wise dot products, same as the diagonal of -sim_fn(x, y, bias) without the n x n matrix
+		sim = (x * y).sum(1)
+		return -sim if bias is None else -(sim + bias)
 	else:
 		return -sim_fn(x, y, bias=bias)
 
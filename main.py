@@ -1,4 +1,9 @@
 import argparse
+import os
+import sys
+import signal
+import hashlib
+import copy
 import time
 import math
 import numpy as np
@@ -8,8 +13,13 @@ import torch.nn as nn
 import data
 from model import RNNModel
 
-from visualize.dump import dump, dump_hiddens, dump_words
-from utils import batchify, batchify_padded, get_batch, repackage_hidden
+from visualize.dump import dump, dump_hiddens, dump_words, HiddenWriter
+from visualize.summary import EvaluationSummary
+from sample import BucketSampler
+from validation import SubsampledValidation, EvaluationCache, evaluate_sharded, init_shard_worker, score_snapshot
+from checkpoint import AsyncCheckpointer
+from utils import batchify, batchify_padded, get_batch, repackage_hidden, memory_usage, SpectralNorm
+from timers import timers, trace_profiler
 
 parser = argparse.ArgumentParser(description='PyTorch PennTreeBank RNN/LSTM Language Model')
 parser.add_argument('--data', type=str, default='data/penn/',
@@ -56,6 +66,18 @@ parser.add_argument('--wdecay', type=float, default=1.2e-6,
                     help='weight decay applied to all weights')
 parser.add_argument('--resume', type=str,  default='',
                     help='path of model to resume')
+parser.add_argument('--shared_data', type=str,  default='',
+                    help='directory (e.g. in /dev/shm) in which concurrent jobs on the same data share the tokenized corpus')
+parser.add_argument('--state', type=str,  default='',
+                    help='path of the training state, training continues from it if it exists and it is updated when training stops')
+parser.add_argument('--state_every', type=int, default=0,
+                    help='with --state, also store the training state every this many batches so that training continues at that batch (0 = only at the end and on SIGTERM)')
+parser.add_argument('--async_checkpoint', action='store_true',
+                    help='save state_dicts of the model and the optimizer from a background thread')
+parser.add_argument('--keep_checkpoints', type=int, default=0,
+                    help='with --async_checkpoint, number of previous versions of a checkpoint kept as <save>.1, <save>.2, ...')
+parser.add_argument('--skip_test', action='store_true',
+                    help='do not evaluate the best model on the test data after training')
 parser.add_argument('--optimizer', type=str,  default='sgd',
                     help='optimizer to use (sgd, adam)')
 parser.add_argument('--when', nargs="+", type=int, default=[-1],
@@ -72,17 +94,94 @@ parser.add_argument('--activation_fn', type=str, default='logsoftmax')
 parser.add_argument('--no_bias', action='store_false')
 parser.add_argument('--uni_freq', action='store_true')
 parser.add_argument('--reinit_h', action='store_true')
+parser.add_argument('--bucketing', action='store_true',
+                    help='with --reinit_h, batch sentences of similar length and mask out padding')
+parser.add_argument('--bucket_pool', type=int, default=50,
+                    help='number of batches whose sentences are sorted by length together')
 parser.add_argument('--bias_reg', type=float, default=0.)
 parser.add_argument('--evaluate_every', type=int, default=1)
+parser.add_argument('--spectral_interval', type=int, default=0,
+                    help='log the largest singular value of W_hh every this many batches (0 = only at the end of every epoch)')
+parser.add_argument('--fast_valid', type=int, default=0,
+                    help='with --reinit_h, estimate the validation loss on this many random sentences, 0 = always run the full pass')
+parser.add_argument('--eval_workers', type=int, default=0,
+                    help='with --reinit_h on the cpu, score the sentences of the validation and test data in this many processes')
+parser.add_argument('--sampled_valid', type=int, default=0,
+                    help='estimate the validation loss with this many importance samples of the partition function per token, 0 = exact')
+parser.add_argument('--abort_valid', action='store_true',
+                    help='stop the validation pass once its partial loss shows that it can neither set a new best nor change the switch to ASGD')
+parser.add_argument('--eval_cache', type=str, default='',
+                    help='directory in which evaluation results are stored, keyed by a hash of the model, the data and the settings')
+parser.add_argument('--eval_temperatures', nargs='+', type=float, default=None,
+                    help='after the test pass, report the validation loss of the best model under each of these temperatures (single pass)')
+parser.add_argument('--background_valid', action='store_true',
+                    help='validate a snapshot of every epoch in a separate process while the next epoch trains, the checkpoint and the switch to ASGD follow one epoch later (full plain pass only)')
 
 # dump settings
 parser.add_argument('--dump_hiddens', action='store_true')
 parser.add_argument('--dump_words', action='store_true')
 parser.add_argument('--dump_valloss', type=str, default='valloss')
 parser.add_argument('--dump_entropy', type=str, default='entropy_')
-
-args = parser.parse_args()
-args.tied = True
+parser.add_argument('--dump_summary', type=str, default=None,
+                    help='prefix of the histograms and quantile sketches of entropy and target distance computed while evaluating (replaces the per-token --dump_entropy)')
+parser.add_argument('--dump_format', type=str, default='txt', choices=['txt', 'npy'],
+                    help='format of the dumps, text (.out) or binary (.npy)')
+parser.add_argument('--timers', type=str, default=None,
+                    help='append the time spent in every phase of training and evaluation to this file (json lines, one per log interval and evaluation)')
+parser.add_argument('--profile', type=str, default=None,
+                    help='write torch.profiler traces (chrome json and tables sorted by self cpu time) of training and evaluation to this directory')
+parser.add_argument('--profile_steps', type=int, nargs=3, default=[5, 2, 3], metavar=('WAIT', 'WARMUP', 'ACTIVE'),
+                    help='batches (positions for evaluation) skipped, warmed up and recorded by --profile')
+
+def check_args(args, error=parser.error):
+    # rejects combinations of options of which one would be silently ignored
+    if not args.reinit_h:
+        # bucketing regroups sentences, subsampled and sharded sentences are scored from a zero hidden state,
+        # all of which needs the hidden state to be reset at every sentence
+        for name, given in [('--bucketing', args.bucketing), ('--fast_valid', args.fast_valid > 0),
+                            ('--eval_workers', args.eval_workers > 1)]:
+            if given:
+                error(name + ' requires --reinit_h')
+    if args.eval_workers > 1 and args.cuda:
+        # --cuda is a switch that turns cuda off
+        error('--eval_workers scores on the cpu, pass --cuda to train without cuda')
+    if args.eval_temperatures and args.skip_test:
+        error('--eval_temperatures scores the best model after the test pass and cannot be combined with --skip_test')
+    if args.dump_hiddens:
+        for name, given in [('--eval_workers', args.eval_workers > 1), ('--eval_cache', bool(args.eval_cache))]:
+            if given:
+                error('--dump_hiddens collects the hidden states in a plain evaluation pass and cannot be combined with ' + name)
+    if args.dump_summary is not None:
+        for name, given in [('--eval_workers', args.eval_workers > 1), ('--eval_cache', bool(args.eval_cache)),
+                            ('--dump_hiddens', args.dump_hiddens)]:
+            if given:
+                error('--dump_summary is computed in a plain evaluation pass and cannot be combined with ' + name)
+    if args.background_valid:
+        for name, given in [('--fast_valid', args.fast_valid > 0), ('--sampled_valid', args.sampled_valid > 0),
+                            ('--eval_workers', args.eval_workers > 1), ('--eval_cache', bool(args.eval_cache)),
+                            ('--dump_summary', args.dump_summary is not None), ('--dump_hiddens', args.dump_hiddens)]:
+            if given:
+                error('--background_valid runs a plain full validation pass and cannot be combined with ' + name)
+
+def load_corpus(args):
+    # with --shared_data the corpus is published once as memory-mapped files which all jobs attach to
+    if args.shared_data:
+        if not os.path.exists(os.path.join(args.shared_data, 'tokens.json')):
+            load_corpus(argparse.Namespace(**dict(vars(args), shared_data=''))).save_binary(args.shared_data)
+        return data.Corpus(args.shared_data)
+
+    # the tokenized corpus is cached in the working directory, keyed by the data path
+    fn = 'corpus.{}.data'.format(hashlib.md5(args.data.encode()).hexdigest())
+    if os.path.exists(fn):
+        print('Loading cached dataset...')
+        corpus = torch.load(fn, weights_only=False)
+    else:
+        print('Producing dataset...')
+        corpus = data.Corpus(args.data)
+        # write to a temporary file first so that concurrent jobs never read a partial cache
+        torch.save(corpus, fn + '.' + str(os.getpid()))
+        os.replace(fn + '.' + str(os.getpid()), fn)
+    return corpus
 
 def run(args):
 
@@ -98,25 +197,52 @@ def run(args):
     # Load data
     ###############################################################################
 
-    def model_save(fn):
+    # with --async_checkpoint, checkpoints are state_dicts written in the background
+    checkpointer = AsyncCheckpointer(args.keep_checkpoints) if args.async_checkpoint else None
+
+    # with --timers, cuda is synchronized around the phases so that kernels are attributed correctly
+    if args.timers is not None:
+        timers.enable(args.timers, sync=args.cuda and torch.cuda.is_available())
+
+    def model_save(fn, snapshot=None):
+        if checkpointer is not None:
+            m, o = snapshot if snapshot is not None else [model, optimizer]
+            checkpointer.save(fn, {'model': m.state_dict(), 'optimizer': o.state_dict(), 'optimizer_type': type(o).__name__})
+            return
         with open(fn, 'wb') as f:
-            torch.save([model, optimizer], f)
+            torch.save(snapshot if snapshot is not None else [model, optimizer], f)
+
+    def checkpoint_load(fn):
+        # loads the parameters of a state_dict checkpoint into the current model
+        checkpointer.wait()
+        with open(fn, 'rb') as f:
+            model.load_state_dict(torch.load(f)['model'])
 
     def model_load(fn):
-        global model, criterion, optimizer
+        if checkpointer is not None:
+            return checkpoint_load(fn)
+        nonlocal model, optimizer
         with open(fn, 'rb') as f:
-            model, optimizer = torch.load(f)
+            model, optimizer = torch.load(f, weights_only=False)
 
-    import os
-    import hashlib
-    fn = 'corpus.{}.data'.format(hashlib.md5(args.data.encode()).hexdigest())
-    if os.path.exists(fn):
-        print('Loading cached dataset...')
-        corpus = torch.load(fn)
-    else:
-        print('Producing dataset...')
-        corpus = data.Corpus(args.data)
-        torch.save(corpus, fn)
+    def state_save(fn, epoch, position=None):
+        # everything needed to continue training after epoch, position is the place in the next epoch
+        with open(fn + '.tmp', 'wb') as f:
+            torch.save({'model': model, 'optimizer': optimizer, 'epoch': epoch, 'position': position,
+                        'best_val_loss': best_val_loss, 'valid_loss': valid_loss, 'stored_loss': stored_loss,
+                        'rng': rng_state()}, f)
+        os.replace(fn + '.tmp', fn)
+
+    def rng_state():
+        return [np.random.get_state(), torch.get_rng_state()] + ([torch.cuda.get_rng_state_all()] if args.cuda else [])
+
+    def set_rng_state(rng):
+        np.random.set_state(rng[0])
+        torch.set_rng_state(rng[1])
+        if len(rng) > 2: torch.cuda.set_rng_state_all(rng[2])
+
+    print('| memory before loading data | rss {:8.1f} MB | private {:8.1f} MB'.format(*memory_usage()))
+    corpus = load_corpus(args)
 
     # get token frequencies and eos_tokens
     frequencies, eos_tokens = None, None
@@ -127,14 +253,19 @@ def run(args):
     eval_batch_size = 1
     test_batch_size = 1
     print(corpus.dictionary)
+    seq_lens, train_sampler = None, None
     if args.reinit_h:
         ntokens = len(corpus.dictionary) + 1 if args.batch_size > 1 else len(corpus.dictionary)
         train_data, seq_lens = batchify_padded(corpus.train, args.batch_size, args, ntokens, eos_tokens)    
+        if args.bucketing:
+            train_sampler = BucketSampler(corpus.train, args.batch_size, eos_tokens, ntokens-1, args.bucket_pool)
+            print('Padding ratio without bucketing: {:5.3f}'.format(train_sampler.padding_ratio(seq_lens)))
     else:
         ntokens = len(corpus.dictionary)
-        train_data = batchify(corpus.train, args.batch_size, args)
-    val_data = batchify(corpus.valid, eval_batch_size, args)
-    test_data = batchify(corpus.test, test_batch_size, args)
+        train_data = batchify(corpus.train, args.batch_size, args, 'train')
+    val_data = batchify(corpus.valid, eval_batch_size, args, 'valid')
+    test_data = batchify(corpus.test, test_batch_size, args, 'test')
+    print('| memory after loading data  | rss {:8.1f} MB | private {:8.1f} MB'.format(*memory_usage()))
 
     ###############################################################################
     # Build the model
@@ -163,36 +294,212 @@ def run(args):
     # Training code
     ###############################################################################
 
-    def evaluate(data_source, epoch, batch_size=1):
+    # sentences are independent with --reinit_h, so evaluation can be sharded over processes
+    eval_pool = None
+    if args.eval_workers > 1:
+        threads = max(1, torch.get_num_threads() // args.eval_workers)
+        eval_pool = torch.multiprocessing.get_context('spawn').Pool(args.eval_workers, init_shard_worker, (threads,))
+
+    # results of evaluating the same model on the same data are looked up instead of recomputed
+    eval_cache = EvaluationCache(args.eval_cache) if args.eval_cache else None
+
+    profiled_evaluation = False
+
+    def profile_evaluation(data_source):
+        # a separate pass over just the positions of the profiler window
+        wait, warmup, active = args.profile_steps
+        with trace_profiler(args.profile, 'evaluate', wait, warmup, active) as prof:
+            model.evaluate(data_source[:wait + warmup + active], eos_tokens, step=prof.step)
+
+    def evaluate(data_source, epoch, batch_size=1, bound=None):
+        nonlocal profiled_evaluation
         # Turn on evaluation mode which disables dropout.
         model.eval()
 
-        if args.dump_hiddens:
+        # a second profiler session would end the one of the training window, so this waits until it is recorded
+        if args.profile is not None and not profiled_evaluation and train_profiler is None:
+            profile_evaluation(data_source)
+            profiled_evaluation = True
+
+        def score():
+            if eval_pool is not None:
+                return evaluate_sharded(model, data_source, eos_tokens, eval_pool, 4 * args.eval_workers, bound)
+            return model.evaluate(data_source, eos_tokens, bound=bound)
+
+        if args.dump_hiddens and args.dump_format == 'npy':
+            # streamed to disk while evaluating
+            writer = HiddenWriter('hiddens_' + str(epoch), data_source.size(0), model.nhid)
+            loss, entropy = model.evaluate(data_source, eos_tokens, hidden_writer=writer)
+            writer.close()
+        elif args.dump_hiddens:
             loss, entropy, hiddens = model.evaluate(data_source, eos_tokens, args.dump_hiddens)
-            dump_hiddens(hiddens, 'hiddens_' + str(epoch))
+            dump_hiddens(hiddens, 'hiddens_' + str(epoch), args.dump_format)
+        elif args.dump_summary is not None:
+            # histograms and sketches are accumulated while evaluating instead of dumping every token
+            summary = EvaluationSummary()
+            loss, entropy = model.evaluate(data_source, eos_tokens, bound=bound, summary=summary)
+            if len(entropy) == data_source.size(0): summary.save(args.dump_summary + str(epoch))
+        elif eval_cache is not None:
+            loss, entropy = eval_cache.evaluate(model, data_source, eos_tokens, score)
         else:
-            loss, entropy = model.evaluate(data_source, eos_tokens)
-        
+            loss, entropy = score()
+
+        finish_evaluation(data_source, epoch, loss, entropy, bound, model.encoder)
+        timers.emit(phase='evaluate', epoch=epoch, tokens=len(entropy))
+        return loss
+
+    def finish_evaluation(data_source, epoch, loss, entropy, bound, encoder):
         if args.dump_words:
-            dump_words(model.encoder.weight.detach().cpu().numpy(), 'words_' + str(epoch))
+            dump_words(encoder.weight.detach().cpu().numpy(), 'words_' + str(epoch), args.dump_format)
+
+        if len(entropy) < data_source.size(0):
+            # aborted, loss is only a lower bound and the entropy is incomplete
+            print('| validation aborted | loss >= {:5.2f} > bound {:5.2f} | {:4.1f}% of tokens skipped'.format(
+                loss, bound, 100. * (1. - len(entropy) / data_source.size(0))))
+        elif not args.dump_entropy is None and args.dump_summary is None:
+            # the summary replaces the per-token dump
+            dump(entropy, args.dump_entropy + str(epoch), args.dump_format)
+
+    fast_val = None
+    if args.fast_valid > 0:
+        fast_val = SubsampledValidation(val_data, args.fast_valid, eos_tokens, args.bptt, args.seed)
+
+    def decisive_bound():
+        # the validation loss only matters if it sets a new best or decides the switch to ASGD,
+        # returns the loss above which neither can happen (None if every value matters)
+        if args.optimizer == 'sgd' and 't0' not in optimizer.param_groups[0]:
+            # the loss enters the nonmono window of later epochs until the switch is decided
+            if len(best_val_loss) <= args.nonmono:
+                return None
+            return max(stored_loss, min(best_val_loss[:-args.nonmono]))
+        return stored_loss
+
+    def abort_bound():
+        return decisive_bound() if args.abort_valid else None
+
+    def validate(epoch):
+        # with --fast_valid only a subset is scored, the full pass is reserved for epochs at which
+        # the estimate could set a new best (and the checkpoint would be saved) or enter the nonmono
+        # window of the switch to ASGD, with --sampled_valid log Z is estimated from importance samples
+        # instead. an estimate is only returned if its whole confidence interval lies above the bound,
+        # so it neither changes the best loss nor the switch decision (the loss exceeds the nonmono minimum either way)
+        if fast_val is not None:
+            model.eval()
+            estimate, (low, high) = fast_val.evaluate(model, eos_tokens, cache=eval_cache)
+            print('| fast validation | {:4.1f}% of tokens | valid loss {:5.2f} | 95% ci [{:5.2f}, {:5.2f}]'.format(
+                100 * fast_val.fraction, estimate, low, high))
+        elif args.sampled_valid > 0:
+            model.eval()
+            sample = lambda: model.evaluate_sampled(val_data, eos_tokens, args.sampled_valid)
+            if eval_cache is not None:
+                # a hit returns the estimate of the earlier run instead of drawing new samples
+                estimate, _ = eval_cache.evaluate(model, val_data, eos_tokens, sample, setting=('sampled', args.sampled_valid))
+            else:
+                estimate, _ = sample()
+            low = estimate
+            print('| sampled validation | {:d} samples | valid loss {:5.2f}'.format(args.sampled_valid, estimate))
+        else:
+            return evaluate(val_data, epoch, eval_batch_size, abort_bound())
 
-        if not args.dump_entropy is None:
-            dump(entropy, args.dump_entropy + str(epoch))
+        bound = decisive_bound()
+        if bound is None or low < bound:
+            return evaluate(val_data, epoch, eval_batch_size, abort_bound())
+        return estimate
 
-        return loss
+    def record_validation(epoch, val_loss, epoch_time, averaged, snapshot=None):
+        # checkpoint and ASGD bookkeeping, snapshot is the validated [model, optimizer] if it is not the current one
+        nonlocal stored_loss, optimizer
+        valid_loss.append(val_loss)
+        print('-' * 89)
+        print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | '
+            'valid ppl {:8.2f} | valid bpc {:8.3f}'.format(
+                epoch, epoch_time, val_loss, math.exp(val_loss), val_loss / math.log(2)))
+        print('-' * 89)
+
+        if val_loss < stored_loss:
+            model_save(args.save, snapshot)
+            print('Saving Averaged!' if averaged else 'Saving model (new best validation)')
+            stored_loss = val_loss
 
+        if averaged:
+            return
 
-    def train():
+        if args.optimizer == 'sgd' and 't0' not in optimizer.param_groups[0] and (len(best_val_loss)>args.nonmono and val_loss > min(best_val_loss[:-args.nonmono])):
+            print('Switching to ASGD')
+            optimizer = torch.optim.ASGD(model.parameters(), lr=args.lr, t0=0, lambd=0., weight_decay=args.wdecay)
+
+        best_val_loss.append(val_loss)
+
+    # with --background_valid, a copy of the model at the end of every epoch is validated in a separate process
+    valid_pool, pending = None, None
+    if args.background_valid:
+        valid_pool = torch.multiprocessing.get_context('spawn').Pool(1, init_shard_worker, (max(1, torch.get_num_threads() // 2),))
+
+    def snapshot_params():
+        # copy of the model (holding the ASGD averages if there are any) and of the optimizer
+        model.eval()
+        model.rnn._setweights()
+        snapshot = copy.deepcopy([model, optimizer])
+        for prm in snapshot[0].parameters():
+            if 'ax' in snapshot[1].state[prm]:
+                prm.data = snapshot[1].state[prm]['ax'].clone()
+        return snapshot
+
+    def collect(pending):
+        # waits for a background validation and records it
+        epoch, epoch_time, averaged, snapshot, bound, result = pending
+        val_loss, entropy = result.get()
+        finish_evaluation(val_data, epoch, val_loss, entropy, bound, snapshot[0].encoder)
+        record_validation(epoch, val_loss, epoch_time, averaged, snapshot)
+
+
+    # power iteration on W_hh, the vector is carried over between calls
+    spectral_norm = SpectralNorm()
+
+    def train(position=None):
+        nonlocal train_profiler, profiler_steps
+        # position (optional) continues an interrupted epoch at the stored batch
         # Turn on training mode which enables dropout.
-        total_loss, avrg_loss = 0, 0
+        total_loss, avrg_loss, total_tokens = 0, 0, 0
+        # batches since the last emit of the timers
+        timed_batches = 0
         start_time = time.time()
         ntokens = len(corpus.dictionary)
         batch, i = 0, 0
         hidden = model.init_hidden(args.batch_size)
-        while i < train_data.size(0)-1:
+
+        # the random state at the start of the epoch determines the batches of the bucket sampler
+        epoch_rng = np.random.get_state()
+        if position is not None:
+            epoch_rng = position['epoch_rng']
+            np.random.set_state(epoch_rng)
+
+        # with bucketing, sentences are regrouped every epoch and padding is masked out
+        source, batch_lens, lengths = train_data, seq_lens, None
+        if train_sampler is not None:
+            source, batch_lens, lengths = train_sampler.epoch()
+            if args.cuda: source = source.cuda()
+            print('| epoch {:3d} | padding ratio {:5.3f}'.format(epoch, train_sampler.padding_ratio(batch_lens)))
+
+        if position is not None:
+            batch, i, hidden = position['batch'], position['i'], position['hidden']
+            total_loss, avrg_loss, total_tokens = position['losses']
+            set_rng_state(position['rng'])
+            print('| epoch {:3d} | continuing at batch {:5d}'.format(epoch, batch))
+
+        while i < source.size(0)-1:
+
+            # store the state to continue at this batch, and stop if the job is being preempted
+            if args.state and (preempted or (args.state_every > 0 and batch > 0 and batch % args.state_every == 0)):
+                here = {'batch': batch, 'i': i, 'hidden': hidden, 'epoch_rng': epoch_rng,
+                        'losses': (total_loss, avrg_loss, total_tokens), 'rng': rng_state()}
+                if preempted:
+                    print('| epoch {:3d} | stopped at batch {:5d}'.format(epoch, batch))
+                    stop_preempted(epoch - 1, here)
+                state_save(args.state, epoch - 1, here)
 
             if args.reinit_h:
-                seq_len = seq_lens[batch] - 1
+                seq_len = batch_lens[batch] - 1
             else:
                 bptt = args.bptt if np.random.random() < 0.95 else args.bptt / 2.
                 # Prevent excessively small or negative sequence lengths
@@ -204,7 +511,8 @@ def run(args):
             lr2 = optimizer.param_groups[0]['lr']
             optimizer.param_groups[0]['lr'] = lr2 * seq_len / args.bptt
             model.train()
-            data = get_batch(train_data, i, args, seq_len=seq_len)
+            with timers('train.get_batch'):
+                data = get_batch(source, i, args, seq_len=seq_len)
 
             # Starting each batch, we detach the hidden state from how it was previously produced.
             # If we didn't, the model would try backpropagating all the way to start of the dataset.
@@ -216,7 +524,9 @@ def run(args):
             optimizer.zero_grad()
 
             #raw_loss = model.train_crossentropy(data, eos_tokens)
-            raw_loss, hidden = model(data, hidden)
+            with timers('train.forward'):
+                raw_loss, hidden = model(data, hidden, lengths=None if lengths is None else lengths[batch])
+            total_tokens += data.numel() if lengths is None else int(lengths[batch].sum())
 
             loss = raw_loss
             '''
@@ -227,35 +537,88 @@ def run(args):
             # Temporal Activation Regularization (slowness)
             if args.beta: loss = loss + sum(args.beta * (rnn_h[1:] - rnn_h[:-1]).pow(2).mean() for rnn_h in rnn_hs[-1:])
             '''
-            loss.backward()
+            with timers('train.backward'):
+                loss.backward()
 
             # `clip_grad_norm` helps prevent the exploding gradient problem in RNNs / LSTMs.
-            if args.clip: torch.nn.utils.clip_grad_norm_(params, args.clip)
-            optimizer.step()
+            with timers('train.clip'):
+                if args.clip: torch.nn.utils.clip_grad_norm_(params, args.clip)
+            with timers('train.optimizer'):
+                optimizer.step()
 
             total_loss += loss.data
+            timed_batches += 1
             optimizer.param_groups[0]['lr'] = lr2
+            if args.spectral_interval > 0 and batch % args.spectral_interval == 0:
+                print('| epoch {:3d} | {:5d}/{:5d} batches | spectral norm W_hh {:8.4f}'.format(
+                    epoch, batch, len(source) // args.bptt, spectral_norm(model.rnn.module.weight_hh_l0_raw)))
             if batch % args.log_interval == 0 and batch > 0:
                 cur_loss = total_loss.item() / args.log_interval
                 elapsed = time.time() - start_time
-                print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:05.5f} | ms/batch {:5.2f} | '
+                print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:05.5f} | ms/batch {:5.2f} | tok/s {:8.0f} | '
                         'loss {:5.2f} | ppl {:8.2f} | bpc {:8.3f}'.format(
-                    epoch, batch, len(train_data) // args.bptt, optimizer.param_groups[0]['lr'],
-                    elapsed * 1000 / args.log_interval, cur_loss, cur_loss, cur_loss / math.log(2)))
+                    epoch, batch, len(source) // args.bptt, optimizer.param_groups[0]['lr'],
+                    elapsed * 1000 / args.log_interval, total_tokens / elapsed, cur_loss, cur_loss, cur_loss / math.log(2)))
+                timers.emit(phase='train', epoch=epoch, batch=batch, batches=timed_batches, tokens=total_tokens, ms=elapsed * 1000)
                 avrg_loss = avrg_loss + total_loss
-                total_loss = 0
+                total_loss, total_tokens, timed_batches = 0, 0, 0
                 start_time = time.time()
             ###
             batch += 1
             i += seq_len + 1
-
-        return avrg_loss / train_data.size(0)
+            if train_profiler is not None:
+                train_profiler.step()
+                profiler_steps += 1
+                if profiler_steps == sum(args.profile_steps):
+                    # the window is recorded and its trace written
+                    train_profiler.stop()
+                    train_profiler = None
+
+        # the batches since the last log interval
+        timers.emit(phase='train', epoch=epoch, batch=batch, batches=timed_batches, tokens=total_tokens,
+                    ms=(time.time() - start_time) * 1000)
+        return avrg_loss / source.size(0)
 
     # Loop over epochs.
     lr = args.lr
     best_val_loss = []
     valid_loss = []
     stored_loss = 100000000
+    epochs_done, position = 0, None
+
+    # on SIGTERM (e.g. preemption) the state is stored at the next batch or after the current validation and training stops
+    preempted = False
+    def on_sigterm(signum, frame):
+        nonlocal preempted
+        preempted = True
+
+    def stop_preempted(epoch, position=None):
+        # an outstanding background validation is recorded first (so it may switch to ASGD a few batches
+        # early), then the state is stored, the checkpoints are written and the workers are shut down
+        if pending is not None:
+            collect(pending)
+        state_save(args.state, epoch, position)
+        print('| state stored in {}'.format(args.state))
+        if checkpointer is not None:
+            checkpointer.wait()
+        for pool in (valid_pool, eval_pool):
+            if pool is not None: pool.close()
+        timers.close()
+        sys.exit(128 + signal.SIGTERM)
+
+    if args.state:
+        previous_handler = signal.signal(signal.SIGTERM, on_sigterm)
+
+    # with --profile, one window of batches is recorded, validation passes falling into it are part of the
+    # recorded steps and the separate profile of evaluate is taken at the first evaluation after the window
+    train_profiler, profiler_steps = None, 0
+    if args.profile is not None:
+        batches = len(seq_lens) if seq_lens is not None else train_data.size(0) // args.bptt
+        if sum(args.profile_steps) > args.epochs * batches:
+            print('WARNING: --profile_steps spans {} batches but training runs for about {}, no training trace will be written'.format(
+                sum(args.profile_steps), args.epochs * batches))
+        train_profiler = trace_profiler(args.profile, 'train', *args.profile_steps)
+        train_profiler.start()
 
     # At any point you can hit Ctrl + C to break out of training early.
     try:
@@ -265,11 +628,24 @@ def run(args):
             optimizer = torch.optim.SGD(params, lr=args.lr, weight_decay=args.wdecay)
         if args.optimizer == 'adam':
             optimizer = torch.optim.Adam(params, lr=args.lr, weight_decay=args.wdecay)
-        for epoch in range(1, args.epochs+1):
+
+        # continue from a previously stored training state
+        if args.state and os.path.exists(args.state):
+            with open(args.state, 'rb') as f:
+                state = torch.load(f, weights_only=False)
+            model, optimizer = state['model'], state['optimizer']
+            params = list(model.parameters())
+            best_val_loss, valid_loss, stored_loss = state['best_val_loss'], state['valid_loss'], state['stored_loss']
+            set_rng_state(state['rng'])
+            epochs_done, position = state['epoch'], state.get('position')
+            print('Continuing after epoch {} from {}'.format(epochs_done, args.state))
+
+        for epoch in range(epochs_done+1, args.epochs+1):
             epoch_start_time = time.time()
-            train_loss = train()
-            _, s, _= np.linalg.svd(model.rnn.module.weight_hh_l0.cpu().detach().numpy())
-            print(s[0])
+            train_loss = train(position)
+            position = None
+            epochs_done = epoch
+            print('| end of epoch {:3d} | spectral norm W_hh {:8.4f}'.format(epoch, spectral_norm(model.rnn.module.weight_hh_l0_raw, niter=20)))
             #dump(model.decoder.bias.cpu().detach().numpy(), 'bias_' + str(epoch) +'.out')
             
             # skip to beginning if not in evaluation mode
@@ -281,7 +657,18 @@ def run(args):
                 continue
 
             # evaluate validation loss 
-            if 't0' in optimizer.param_groups[0]:
+            averaged = 't0' in optimizer.param_groups[0]
+            if args.background_valid:
+                # the snapshot is taken before the previous result can switch the optimizer,
+                # the previous result is recorded before the bound for this epoch is computed
+                snapshot = snapshot_params()
+                if pending is not None:
+                    collect(pending)
+                bound = abort_bound()
+                pending = (epoch, time.time() - epoch_start_time, averaged, snapshot, bound,
+                           valid_pool.apply_async(score_snapshot, (snapshot[0], val_data, eos_tokens, bound)))
+
+            elif averaged:
                 tmp = {}
                 for prm in model.parameters():
                     #if 'ax' in optimizer.state[prm]:
@@ -289,51 +676,73 @@ def run(args):
                     if 'ax' in optimizer.state[prm]:
                         prm.data = optimizer.state[prm]['ax'].clone()
 
-                val_loss2 = evaluate(val_data, epoch)
-                valid_loss.append(val_loss2)
-                print('-' * 89)
-                print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | '
-                    'valid ppl {:8.2f} | valid bpc {:8.3f}'.format(
-                        epoch, (time.time() - epoch_start_time), val_loss2, math.exp(val_loss2), val_loss2 / math.log(2)))
-                print('-' * 89)
-
-                if val_loss2 < stored_loss:
-                    model_save(args.save)
-                    print('Saving Averaged!')
-                    stored_loss = val_loss2
+                val_loss2 = validate(epoch)
+                record_validation(epoch, val_loss2, time.time() - epoch_start_time, averaged)
 
                 for prm in model.parameters():
                     prm.data = tmp[prm].clone()
 
             else:
-                val_loss = evaluate(val_data, epoch, eval_batch_size)
-                valid_loss.append(val_loss)
-                print('-' * 89)
-                print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | '
-                    'valid ppl {:8.2f} | valid bpc {:8.3f}'.format(
-                  epoch, (time.time() - epoch_start_time), val_loss, math.exp(val_loss), val_loss / math.log(2)))
-                print('-' * 89)
+                val_loss = validate(epoch)
+                record_validation(epoch, val_loss, time.time() - epoch_start_time, averaged)
 
-                if val_loss < stored_loss:
-                    model_save(args.save)
-                    print('Saving model (new best validation)')
-                    stored_loss = val_loss
+            if not averaged and epoch in args.when:
+                print('Saving model before learning rate decreased')
+                model_save('{}.e{}'.format(args.save, epoch))
+                print('Dividing learning rate by 10')
+                optimizer.param_groups[0]['lr'] /= 10.
 
-                if args.optimizer == 'sgd' and 't0' not in optimizer.param_groups[0] and (len(best_val_loss)>args.nonmono and val_loss > min(best_val_loss[:-args.nonmono])):
-                    print('Switching to ASGD')
-                    optimizer = torch.optim.ASGD(model.parameters(), lr=args.lr, t0=0, lambd=0., weight_decay=args.wdecay)
+            if preempted:
+                print('| end of epoch {:3d} | stopped'.format(epoch))
+                stop_preempted(epoch)
 
-                if epoch in args.when:
-                    print('Saving model before learning rate decreased')
-                    model_save('{}.e{}'.format(args.save, epoch))
-                    print('Dividing learning rate by 10')
-                    optimizer.param_groups[0]['lr'] /= 10.
+        # the last background validation is still outstanding
+        if pending is not None:
+            collect(pending)
+            pending = None
 
-                best_val_loss.append(val_loss)
+        if preempted:
+            print('| end of training | stopped')
+            stop_preempted(epochs_done)
 
     except KeyboardInterrupt:
         print('-' * 89)
         print('Exiting from training early')
+        if pending is not None:
+            # the worker received the interrupt as well, its result is lost
+            valid_pool.terminate()
+            pending = None
+
+    if valid_pool is not None:
+        valid_pool.close()
+
+    if train_profiler is not None:
+        print('WARNING: training stopped after {} of the {} batches of --profile_steps, the training trace is incomplete or missing'.format(
+            profiler_steps, sum(args.profile_steps)))
+        train_profiler.stop()
+        train_profiler = None
+
+    if args.state:
+        state_save(args.state, epochs_done)
+
+    if checkpointer is not None:
+        checkpointer.wait()
+        print('| checkpoints | {checkpoints} written | mean stall {mean_stall:6.1f} ms | max stall {max_stall:6.1f} ms | '
+              'mean write {mean_write:6.1f} ms'.format(**checkpointer.stats()))
+
+    # everything needed to continue is written, from here on SIGTERM ends the job right away
+    if args.state:
+        signal.signal(signal.SIGTERM, previous_handler)
+        if preempted:
+            print('| end of training | stopped before the test pass')
+            stop_preempted(epochs_done)
+
+    if args.skip_test:
+        if eval_cache is not None:
+            print('| evaluation cache | {hits} hits | {misses} misses | hit rate {hit_rate:5.2f}'.format(**eval_cache.stats()))
+        if eval_pool is not None: eval_pool.close()
+        timers.close()
+        return np.array(valid_loss), None
 
     # Load the best saved model.
     model_load(args.save)
@@ -344,33 +753,52 @@ def run(args):
     print('| End of training | test loss {:5.2f} | test ppl {:8.2f} | test bpc {:8.3f}'.format(
         test_loss, math.exp(test_loss), test_loss / math.log(2)))
     print('=' * 89)
+    if eval_cache is not None:
+        print('| evaluation cache | {hits} hits | {misses} misses | hit rate {hit_rate:5.2f}'.format(**eval_cache.stats()))
 
+    # the distances do not depend on the temperature, so all temperatures are scored together
+    if args.eval_temperatures:
+        model.eval()
+        temp_loss, _ = model.evaluate(val_data, eos_tokens, temperatures=args.eval_temperatures)
+        for temp, loss in zip(args.eval_temperatures, temp_loss):
+            print('| temperature {:8.2f} | valid loss {:5.2f} | valid ppl {:8.2f} | valid bpc {:8.3f}'.format(
+                temp, loss, math.exp(loss), loss / math.log(2)))
+        print('=' * 89)
+
+    if eval_pool is not None: eval_pool.close()
+    timers.close()
     return np.array(valid_loss), test_loss
 
 '''
     ### MAIN ###
 '''
 
-#valid_loss, test_loss = run(args)
-
-l = [[('adam', 1e-4), ('adam', 1e-3), ('sgd', 1) , ('sgd', 10)],
-    [-100, -10, -1],
-    ['eucl']]
-args.dump_entropy = None
-args.dump_valloss = None
-import itertools
-L = list(itertools.product(*l))
-results = []
-for (opt, lr), temp, dist_fn in L:
-
-    settings = [opt, lr, temp, dist_fn]
-    args.optimizer = opt
-    args.lr = lr
-    args.temperature = temp
-    args.dist_fn = dist_fn
-
-    valid_loss, test_loss = run(args)
-    results.append(settings + [valid_loss])
-
-for result in results:
-    print(result)
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    check_args(args)
+    args.tied = True
+
+    #valid_loss, test_loss = run(args)
+
+    l = [[('adam', 1e-4), ('adam', 1e-3), ('sgd', 1) , ('sgd', 10)],
+        [-100, -10, -1],
+        ['eucl']]
+    args.dump_entropy = None
+    args.dump_valloss = None
+    import itertools
+    L = list(itertools.product(*l))
+    results = []
+    for (opt, lr), temp, dist_fn in L:
+
+        settings = [opt, lr, temp, dist_fn]
+        args.optimizer = opt
+        args.lr = lr
+        args.temperature = temp
+        args.dist_fn = dist_fn
+
+        valid_loss, test_loss = run(args)
+        results.append(settings + [valid_loss])
+
+    for result in results:
+        print(result)
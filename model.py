@@ -8,7 +8,10 @@ from weight_drop import WeightDrop
 
 from sample import NegativeSampler
 
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
 from utils import repackage_hidden
+from timers import timers
 
 from distance import eucl_distance, dot_distance, cone_distance
 from hb_helpers import pairwise_poinc_distance
@@ -82,113 +85,238 @@ class RNNModel(nn.Module):
         self.encoder.weight.data.uniform_(-initrange, initrange)
         if bias: self.decoder.weight.data.uniform_(-initrange, initrange)
 
-    def forward(self, data, hidden, return_output=False):
+    def forward(self, data, hidden, return_output=False, lengths=None):
+        # lengths (optional, on cpu) holds the number of valid tokens in every column of data,
+        # padded positions then cost nothing in the rnn, the distances and the negative samples
 
         # get batch size and sequence length
         seq_len, bsz = data.size()
 
-        emb = embedded_dropout(self.encoder, data, dropout=self.dropoute if self.training else 0)
-        emb = self.lockdrop(emb, self.dropouti)
+        with timers('forward.embedded_dropout'):
+            emb = embedded_dropout(self.encoder, data, dropout=self.dropoute if self.training else 0)
+            emb = self.lockdrop(emb, self.dropouti)
 
-        raw_output, new_hidden = self.rnn(emb, hidden)          # apply single layer rnn
+        with timers('forward.rnn'):
+            if lengths is None:
+                raw_output, new_hidden = self.rnn(emb, hidden)      # apply single layer rnn
+            else:
+                packed = pack_padded_sequence(emb, lengths.clamp(min=1), enforce_sorted=False)
+                raw_output, new_hidden = self.rnn(packed, hidden)
+                raw_output, _ = pad_packed_sequence(raw_output, total_length=seq_len)
         raw_output = self.lockdrop(raw_output, self.dropout)    # seq_len x bsz x nhid
         raw_output = raw_output.view(seq_len, bsz, -1)          # reshape for concat
         raw_output = torch.cat((hidden, raw_output), 0)         # concatenate initial hidden state
 
-        # initialize loss w/ positive terms
-        pos_sample_distances = [self.temp * self.dist_fn(raw_output[i], raw_output[i+1], None if self.bias is None else self.bias[data[i]]) for i in range(seq_len)]
-
-        new_hidden = raw_output[-1].view(1, bsz, -1)            # new hidden is last output
-        raw_output = raw_output[:-1].view(seq_len*bsz, -1)      # hiddens used for negative sampling are all except last
-
-        # x stores the positive samples at index 0 and the negative ones a 1:nsamples+1
-        x = torch.zeros(1+self.nsamples, seq_len*bsz).cuda()
-        for i in range(seq_len):
-            x[0][i*bsz:(i+1)*bsz] = pos_sample_distances[i]
-        
-        # process negative samples
-        samples = self.sampler(bsz, seq_len)    # (nsamples x bsz x seq_len)
-        samples_emb = embedded_dropout(self.encoder, samples, dropout=self.dropoute if self.training else 0)
-        samples_emb = self.lockdrop(samples_emb, self.dropouti)
+        # new hidden is last (valid) output
+        if lengths is None:
+            new_hidden = raw_output[-1].view(1, bsz, -1)
+        else:
+            new_hidden = raw_output[lengths.to(data.device), torch.arange(bsz, device=data.device)].view(1, bsz, -1)
+
+        # flatten the transitions h_i -> h_i+1 (hiddens used for negative sampling are all except last)
+        targets = data.view(-1)
+        raw_output, next_output = raw_output[:-1].view(seq_len*bsz, -1), raw_output[1:].view(seq_len*bsz, -1)
+        if lengths is not None:
+            valid = (torch.arange(seq_len).unsqueeze(1) < lengths.unsqueeze(0)).view(-1).nonzero().view(-1)
+            valid = valid.to(data.device)
+            raw_output, next_output, targets = raw_output[valid], next_output[valid], targets[valid]
+        ntargets = targets.size(0)
+
+        # x stores the positive samples at index 0 and the negative ones a 1:nsamples+1
+        x = raw_output.new_zeros(1+self.nsamples, ntargets)
+        with timers('forward.positive_distance'):
+            x[0] = self.temp * self.dist_fn(raw_output, next_output, None if self.bias is None else self.bias[targets])
+
+        # process negative samples
+        with timers('forward.negative_sampling'):
+            if lengths is None:
+                samples = self.sampler(bsz, seq_len, cuda=data.is_cuda)     # (nsamples x bsz x seq_len)
+            else:
+                samples = self.sampler(ntargets, 1, cuda=data.is_cuda)      # (nsamples x ntargets)
+        with timers('forward.embedded_dropout'):
+            samples_emb = embedded_dropout(self.encoder, samples, dropout=self.dropoute if self.training else 0)
+            samples_emb = self.lockdrop(samples_emb, self.dropouti)
 
         # only one layer for the moment
         weights_ih, bias_ih = self.rnn.module.weight_ih_l0, self.rnn.module.bias_ih_l0  
         weights_hh, bias_hh = self.rnn.module.weight_hh_l0, self.rnn.module.bias_hh_l0
 
-        # reshape samples for indexing and precompute the inputs to nonlinearity
-        samples = samples.view(self.nsamples, bsz*seq_len)
-        samples_times_W = torch.nn.functional.linear(samples_emb, weights_ih, bias_ih).view(self.nsamples, bsz*seq_len, -1)
-        hiddens_times_U = torch.nn.functional.linear(raw_output, weights_hh, bias_hh)
+        with timers('forward.negative_distance'):
+            # reshape samples for indexing and precompute the inputs to nonlinearity
+            samples = samples.view(self.nsamples, ntargets)
+            samples_times_W = torch.nn.functional.linear(samples_emb, weights_ih, bias_ih).view(self.nsamples, ntargets, -1)
+            hiddens_times_U = torch.nn.functional.linear(raw_output, weights_hh, bias_hh)
         
-        # iterate over samples to update loss
-        for i in range(self.nsamples):
+            # iterate over samples to update loss
+            for i in range(self.nsamples):
 
-            # compute output of negative samples
-            output = self.nonlinearity(samples_times_W[i] + hiddens_times_U)
-            output = self.lockdrop(output.view(1, output.size(0), -1), self.dropout)
-            output = output[0]
+                # compute output of negative samples
+                output = self.nonlinearity(samples_times_W[i] + hiddens_times_U)
+                output = self.lockdrop(output.view(1, output.size(0), -1), self.dropout)
+                output = output[0]
 
-            # compute loss term
-            #bias = None
-            #distance = self.dist_fn(raw_output, output, None)
-            distance = self.dist_fn(raw_output, output, None if self.bias is None else self.bias[samples[i]])
-            #distance = torch.clamp(distance, max=self.clamp)
-            x[i+1] = self.temp * distance
+                # compute loss term
+                #bias = None
+                #distance = self.dist_fn(raw_output, output, None)
+                distance = self.dist_fn(raw_output, output, None if self.bias is None else self.bias[samples[i]])
+                #distance = torch.clamp(distance, max=self.clamp)
+                x[i+1] = self.temp * distance
 
-        loss = self.activation(x)
-        if self.bias_reg > 0: loss = loss + (0 if self.bias is None else self.bias_reg * torch.norm(self.bias).pow(2))
+        with timers('forward.loss'):
+            loss = self.activation(x)
+            if self.bias_reg > 0: loss = loss + (0 if self.bias is None else self.bias_reg * torch.norm(self.bias).pow(2))
 
         return loss, new_hidden
 
 
-    def evaluate(self, data, eos_tokens=None, dump_hiddens=False):
-
-        # get weights and compute WX for all words
+    def evaluate(self, data, eos_tokens=None, dump_hiddens=False, resets=None, bound=None, temperatures=None, hidden_writer=None, summary=None,
+                 step=None):
+        # resets (optional) is a set of positions at which the hidden state is reset before scoring
+        # bound (optional) stops the pass as soon as the running loss exceeds it, since the loss per
+        # token is non-negative the returned loss is then a lower bound and entropy is truncated
+        # temperatures (optional) is a list of temperatures used instead of self.temp, the distances
+        # are computed once per position and loss and entropy are returned per temperature
+        # hidden_writer (optional) receives write(i, hidden, depth, sentence) for every position instead of
+        # collecting the hidden states in memory like dump_hiddens
+        # summary (optional) receives update(entropy, distance) with the entropy (at the first temperature)
+        # and the distance to the target of every position, in chunks of 1024 positions
+        # step (optional) is called after every position, e.g. the step of a torch.profiler
+
+        # get weights and compute WX for all words (weight drop is only applied in training mode)
+        self.rnn._setweights()
         weights_ih, bias_ih = self.rnn.module.weight_ih_l0, self.rnn.module.bias_ih_l0  # only one layer for the moment
         weights_hh, bias_hh = self.rnn.module.weight_hh_l0, self.rnn.module.bias_hh_l0
 
-        all_words = torch.LongTensor([i for i in range(self.ntoken)]).cuda()
-        all_words = embedded_dropout(self.encoder, all_words, dropout=self.dropoute if self.training else 0)
+        with timers('evaluate.setup'):
+            all_words = torch.arange(self.ntoken, device=self.encoder.weight.device)
+            all_words = embedded_dropout(self.encoder, all_words, dropout=self.dropoute if self.training else 0)
+
+            all_words_times_W = torch.nn.functional.linear(all_words, weights_ih, bias_ih)
 
-        all_words_times_W = torch.nn.functional.linear(all_words, weights_ih, bias_ih)
+        temps = torch.tensor([self.temp] if temperatures is None else temperatures, device=all_words.device).view(-1, 1)
 
         # iterate over data set and compute loss
-        total_loss, hidden = 0, self.init_hidden(1)
+        total_loss, hidden = np.zeros(len(temps)), self.init_hidden(1)
         i = 0
 
         entropy, hiddens, all_hiddens = [], [], []
+        depth, sentence = 0, 0
+        target_distance = []
         while i < data.size(0):
 
-            hidden_times_U = torch.nn.functional.linear(hidden[0].repeat(self.ntoken, 1), weights_hh, bias_hh)
-            output = self.nonlinearity(all_words_times_W + hidden_times_U)
+            if resets is not None and i in resets:
+                hidden = self.init_hidden(1)
+                if depth > 0: depth, sentence = 0, sentence + 1
+
+            with timers('evaluate.rnn'):
+                hidden_times_U = torch.nn.functional.linear(hidden[0].repeat(self.ntoken, 1), weights_hh, bias_hh)
+                output = self.nonlinearity(all_words_times_W + hidden_times_U)
 
-            if dump_hiddens: hiddens.append(output[data[i]].data.cpu().numpy())
+            with timers('evaluate.dump'):
+                if dump_hiddens: hiddens.append(output[data[i]].data.cpu().numpy())
+                if hidden_writer is not None: hidden_writer.write(i, output[data[i]], depth, sentence)
 
-            distance = self.dist_fn(hidden[0], output, self.bias)
-            softmaxed = torch.nn.functional.log_softmax(self.temp * distance.view(-1), dim=0)
-            raw_loss = -softmaxed[data[i]].item()
+            with timers('evaluate.distance'):
+                distance = self.dist_fn(hidden[0], output, self.bias)
+            with timers('evaluate.softmax'):
+                softmaxed = torch.nn.functional.log_softmax(temps * distance.view(1, -1), dim=1)
+                raw_loss = -softmaxed[:, data[i]].view(-1).detach().cpu().numpy()
 
             total_loss += raw_loss / data.size(0)
             entropy.append(raw_loss)
+            if summary is not None:
+                target_distance.append(distance.view(-1)[data[i]].item())
+                if len(target_distance) == 1024:
+                    summary.update(np.array(entropy[-1024:])[:, 0], target_distance)
+                    target_distance = []
+            if bound is not None and total_loss.min() > bound:
+                break
 
             if not eos_tokens is None and data[i].data.cpu().numpy()[0] in eos_tokens:
                 hidden = self.init_hidden(1)
+                depth, sentence = 0, sentence + 1
                 if dump_hiddens:
                     all_hiddens.append(hiddens)
                     hiddens = []
             else:
                 hidden = output[data[i]].view(1, 1, -1)
+                depth += 1
             hidden = repackage_hidden(hidden)
+            if step is not None: step()
 
             i = i + 1
 
         all_hiddens = all_hiddens if not eos_tokens is None else hiddens
+        if summary is not None and len(target_distance) > 0:
+            summary.update(np.array(entropy[-len(target_distance):])[:, 0], target_distance)
+
+        # one row of entropy per temperature
+        entropy = np.array(entropy).reshape(-1, len(temps)).T
+        if temperatures is None:
+            total_loss, entropy = total_loss[0], entropy[0]
         
         if dump_hiddens:
-            return total_loss, np.array(entropy), all_hiddens
+            return total_loss, entropy, all_hiddens
         else:
-            return total_loss, np.array(entropy)
+            return total_loss, entropy
+
+
+    def evaluate_sampled(self, data, eos_tokens=None, nsamples=100, chunk_size=1024):
+        """Estimates the loss of evaluate at O(nsamples) instead of O(ntoken) cost per position.
+
+        The target term is computed exactly, the remaining mass of the partition function is
+        importance sampled from the unigram^0.75 distribution of the negative sampler."""
+
+        self.rnn._setweights()
+        weights_ih, bias_ih = self.rnn.module.weight_ih_l0, self.rnn.module.bias_ih_l0
+        weights_hh, bias_hh = self.rnn.module.weight_hh_l0, self.rnn.module.bias_hh_l0
 
+        with torch.no_grad():
+            data = data.view(-1)
+            all_words_times_W = torch.nn.functional.linear(self.encoder.weight, weights_ih, bias_ih)
+
+            # hidden state before every position and output of every target (the next hidden state)
+            resets = torch.zeros_like(data, dtype=torch.bool)
+            if eos_tokens is not None:
+                resets = sum(data == eos for eos in eos_tokens) > 0
+            resets = resets.tolist()
+            data_times_W = all_words_times_W[data]
+            hiddens, outputs = data_times_W.new_zeros(data.size(0), self.nhid), torch.empty_like(data_times_W)
+            hidden = data_times_W.new_zeros(self.nhid)
+            for i in range(data.size(0)):
+                hiddens[i] = hidden
+                outputs[i] = self.nonlinearity(data_times_W[i] + torch.nn.functional.linear(hidden, weights_hh, bias_hh))
+                hidden = hiddens[i].new_zeros(self.nhid) if resets[i] else outputs[i]
+
+            # proposal distribution, words without frequency are never proposed
+            proposal = data_times_W.new_zeros(self.ntoken)
+            frequencies = self.sampler.frequencies.to(proposal.device)
+            proposal[:frequencies.size(0)] = frequencies / frequencies.sum()
+            log_kq = torch.log(nsamples * proposal)
+
+            entropy = data_times_W.new_zeros(data.size(0))
+            for lo in range(0, data.size(0), chunk_size):
+                hidden, targets = hiddens[lo:lo+chunk_size], data[lo:lo+chunk_size]
+                n = targets.size(0)
+
+                # exact target term
+                target = self.temp * self.dist_fn(hidden, outputs[lo:lo+n], None if self.bias is None else self.bias[targets]).view(-1)
+
+                # sampled words other than the target, weighted by 1 / (nsamples * q(w))
+                samples = torch.multinomial(proposal, n * nsamples, replacement=True).view(n, nsamples)
+                hidden_times_U = torch.nn.functional.linear(hidden, weights_hh, bias_hh)
+                output = self.nonlinearity(all_words_times_W[samples] + hidden_times_U.unsqueeze(1))
+                distance = self.dist_fn(hidden.unsqueeze(1).expand_as(output).reshape(n * nsamples, -1),
+                                        output.view(n * nsamples, -1),
+                                        None if self.bias is None else self.bias[samples].view(-1))
+                sampled = self.temp * distance.view(n, nsamples) - log_kq[samples]
+                sampled = sampled.masked_fill(samples == targets.unsqueeze(1), -float('inf'))
+
+                log_z = torch.logsumexp(torch.cat((target.unsqueeze(1), sampled), 1), 1)
+                entropy[lo:lo+n] = log_z - target
+
+        entropy = entropy.cpu().numpy()
+        return entropy.mean(), entropy
 
     def init_hidden(self, bsz):
         weight = next(self.parameters()).data
@@ -1,7 +1,11 @@
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import WeightedRandomSampler
 
+from utils import sentence_boundaries
+from timers import timers
+
 class NegativeSampler(nn.Module):
 
 	def __init__(self, nsamples, frequencies, exp=0.75):
@@ -15,8 +19,62 @@ class NegativeSampler(nn.Module):
 		# returns bsz*seq_len*nsamples samples in shape nsamples x (bsz x seq_len)
 
 		# sample based on frequencies
-		wrs = WeightedRandomSampler(self.frequencies, self.nsamples * bsz * seq_len)
-		samples = torch.LongTensor(list(wrs)).cuda() if cuda else torch.LongTensor(list(wrs))
+		with timers('sampler.draw'):
+			wrs = WeightedRandomSampler(self.frequencies, self.nsamples * bsz * seq_len)
+			samples = torch.LongTensor(list(wrs))
+		if cuda:
+			with timers('sampler.transfer'):
+				samples = samples.cuda()
 
 		return samples.view(-1, bsz)
 
+
+class BucketSampler(object):
+
+	def __init__(self, data, bsz, eos_tokens, pad, pool=50):
+		# groups sentences of similar length into batches of bsz sentences, padded with pad.
+		# every epoch the sentences are shuffled, sorted by length within pools of pool*bsz
+		# sentences and the resulting batches are shuffled again
+
+		self.data = data.long()
+		self.bsz = bsz
+		self.pad = pad
+		self.pool = pool
+		self.starts, self.lengths = sentence_boundaries(self.data, eos_tokens)
+
+	def __len__(self):
+		return (len(self.lengths) + self.bsz - 1) // self.bsz
+
+	def epoch(self):
+		# returns the padded batches in the layout of batchify_padded, i.e. a tensor of shape
+		# sum(seq_lens) x bsz and the list seq_lens, plus the sentence lengths of every batch
+
+		nsent, bsz = len(self.lengths), self.bsz
+		lengths = self.lengths.numpy()
+
+		# shuffle, sort within pools and shuffle the batches
+		perm = np.random.permutation(nsent)
+		pools = [perm[k:k + self.pool * bsz] for k in range(0, nsent, self.pool * bsz)]
+		order = np.concatenate([p[np.argsort(lengths[p], kind='stable')] for p in pools])
+		batches = [order[k:k + bsz] for k in range(0, nsent, bsz)]
+		batches = [batches[k] for k in np.random.permutation(len(batches))]
+
+		# an incomplete batch is filled up with empty sentences
+		sentences = torch.full((len(batches), bsz), -1, dtype=torch.long)
+		for k, b in enumerate(batches):
+			sentences[k, :len(b)] = torch.from_numpy(b)
+		batch_lengths = torch.where(sentences >= 0, self.lengths[sentences.clamp(min=0)], torch.zeros_like(sentences))
+		longest = batch_lengths.max(1)[0]
+
+		# gather all tokens at once, rows past a sentence's end hold the pad token
+		batch_of_row = torch.arange(len(batches)).repeat_interleave(longest)
+		position = torch.arange(int(longest.sum())) - (longest.cumsum(0) - longest)[batch_of_row]
+		index = self.starts[sentences.clamp(min=0)][batch_of_row] + position.unsqueeze(1)
+		valid = position.unsqueeze(1) < batch_lengths[batch_of_row]
+		padded = torch.where(valid, self.data[index.clamp(max=len(self.data) - 1)], torch.full_like(index, self.pad))
+
+		return padded, longest.tolist(), batch_lengths
+
+	def padding_ratio(self, seq_lens):
+		# fraction of padded positions for batches with the given seq_lens
+		return 1. - float(self.lengths.sum()) / (sum(seq_lens) * self.bsz)
@@ -0,0 +1,130 @@
+import argparse
+import os
+import json
+import itertools
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+
+from main import parser, check_args, load_corpus, run
+from utils import batchify
+
+###############################################################################
+# Parallel hyperparameter sweep over main.run
+#
+# Every configuration of the grid is trained in its own worker process which is
+# pinned to a slice of the available cpus. Results (the validation curve and the
+# test loss) are written to one json file per configuration in --results, and
+# configurations whose result file already exists are skipped, so an
+# interrupted sweep can simply be restarted.
+###############################################################################
+
+sweep_parser = argparse.ArgumentParser(parents=[parser], add_help=False,
+                                       description='Parallel hyperparameter sweep for main.py')
+sweep_parser.add_argument('--workers', type=int, default=1,
+                          help='number of configurations trained at the same time')
+sweep_parser.add_argument('--threads', type=int, default=0,
+                          help='cpu threads per worker (0 = split all cpus evenly)')
+sweep_parser.add_argument('--results', type=str, default='sweep',
+                          help='directory in which the result of every configuration is stored')
+sweep_parser.add_argument('--sweep_optimizers', nargs='+', type=str,
+                          default=['adam:1e-4', 'adam:1e-3', 'sgd:1', 'sgd:10'],
+                          help='optimizer:learning_rate pairs')
+sweep_parser.add_argument('--sweep_temperatures', nargs='+', type=float, default=[-100, -10, -1])
+sweep_parser.add_argument('--sweep_dist_fns', nargs='+', type=str, default=['eucl'])
+
+
+def grid(args):
+    # returns the list of (key, settings) of all configurations
+    optimizers = [(opt, float(lr)) for opt, lr in (s.split(':') for s in args.sweep_optimizers)]
+    configs = []
+    for (opt, lr), temp, dist_fn in itertools.product(optimizers, args.sweep_temperatures, args.sweep_dist_fns):
+        settings = {'optimizer': opt, 'lr': lr, 'temperature': temp, 'dist_fn': dist_fn}
+        configs.append(('{}-{}-{}-{}'.format(opt, lr, temp, dist_fn), settings))
+    return configs
+
+def cpu_slices(nworkers, threads):
+    # splits the cpus this process may run on into one slice per worker
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    threads = threads if threads > 0 else max(1, len(cpus) // nworkers)
+    return [cpus[(k * threads) % len(cpus):][:threads] for k in range(nworkers)]
+
+def result_path(results, key):
+    return os.path.join(results, key + '.json')
+
+def write_json(path, obj):
+    # atomic, a crashed worker never leaves a half written result behind
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.replace(path + '.tmp', path)
+
+def run_job(key, settings, args, slots):
+
+    cpus = slots.get()
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(len(cpus))
+
+        job_args = argparse.Namespace(**vars(args))
+        for name, value in settings.items():
+            setattr(job_args, name, value)
+        job_args.save = os.path.join(args.results, key + '.pt')
+
+        # each job logs to its own file instead of interleaving on stdout, a job continuing
+        # from a stored state (the later rungs of asha.py) appends to the log of its earlier runs
+        mode = 'a' if settings.get('state') and os.path.exists(settings['state']) else 'w'
+        with open(os.path.join(args.results, key + '.log'), mode) as f, contextlib.redirect_stdout(f):
+            valid_loss, test_loss = run(job_args)
+
+        result = dict(settings, valid_loss=[float(v) for v in valid_loss],
+                      test_loss=None if test_loss is None else float(test_loss))
+        write_json(result_path(args.results, key), result)
+        return key, result
+    finally:
+        slots.put(cpus)
+
+def sweep(args):
+
+    os.makedirs(args.results, exist_ok=True)
+
+    configs = grid(args)
+    todo = [(key, settings) for key, settings in configs if not os.path.exists(result_path(args.results, key))]
+    print('Sweep: {} configurations, {} already done, {} workers'.format(len(configs), len(configs) - len(todo), args.workers))
+
+    # build the corpus cache (or publish the shared corpus) once so the workers only read it
+    corpus = load_corpus(args)
+    if args.shared_data and not args.reinit_h:
+        batchify(corpus.train, args.batch_size, argparse.Namespace(cuda=False, shared_data=args.shared_data), 'train')
+
+    ctx = multiprocessing.get_context('spawn')
+    slots = ctx.Manager().Queue()
+    for cpus in cpu_slices(args.workers, args.threads):
+        slots.put(cpus)
+
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=ctx) as executor:
+        futures = [executor.submit(run_job, key, settings, args, slots) for key, settings in todo]
+        for future in as_completed(futures):
+            key, result = future.result()
+            print('| done {} | best valid loss {:5.2f} | test loss {:5.2f}'.format(
+                key, min(result['valid_loss'] or [float('nan')]), result['test_loss']))
+
+    results = []
+    for key, settings in configs:
+        with open(result_path(args.results, key), 'r') as f:
+            results.append(json.load(f))
+    return results
+
+
+if __name__ == '__main__':
+
+    args = sweep_parser.parse_args()
+    check_args(args, sweep_parser.error)
+    args.tied = True
+    args.dump_entropy = None
+    args.dump_valloss = None
+
+    for result in sweep(args):
+        print([result['optimizer'], result['lr'], result['temperature'], result['dist_fn'], result['valid_loss']])
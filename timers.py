@@ -0,0 +1,98 @@
+import os
+import json
+import time
+from collections import defaultdict
+
+import torch
+
+
+class _NoTimer(object):
+    # shared context returned while the timers are disabled, entering and leaving it does nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_TIMER = _NoTimer()
+
+class _Timer(object):
+    __slots__ = ('timers', 'name', 'start')
+
+    def __init__(self, timers, name):
+        self.timers, self.name = timers, name
+
+    def __enter__(self):
+        if self.timers.sync: torch.cuda.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timers.sync: torch.cuda.synchronize()
+        self.timers.add(self.name, time.perf_counter() - self.start)
+        return False
+
+class Timers(object):
+    """Opt-in named wall clock timers for the hot paths.
+
+    with timers('forward.rnn'): ... adds the time spent in the block to the phase 'forward.rnn'.
+    Phases nest, the time of an inner phase is also counted in the outer one. While disabled a
+    shared no-op context is returned. emit() writes the totals and call counts since the last
+    emit as one json line. With sync, cuda is synchronized around every phase so that the time
+    of the kernels is attributed to the phase that launched them."""
+
+    def __init__(self):
+        self.enabled, self.sync = False, False
+        self.totals, self.counts = defaultdict(float), defaultdict(int)
+        self.out = None
+
+    def enable(self, path, sync=False):
+        self.out = open(path, 'a')
+        self.enabled, self.sync = True, sync
+
+    def __call__(self, name):
+        return _Timer(self, name) if self.enabled else NO_TIMER
+
+    def add(self, name, seconds):
+        self.totals[name] += seconds
+        self.counts[name] += 1
+
+    def reset(self):
+        self.totals.clear()
+        self.counts.clear()
+
+    def emit(self, **fields):
+        # fields (e.g. epoch and batch) are stored next to the phases, totals are in milliseconds
+        if not self.enabled or not self.totals:
+            return
+        record = dict(fields, time=time.time())
+        record['phases'] = {name: {'ms': 1000 * self.totals[name], 'calls': self.counts[name]} for name in sorted(self.totals)}
+        self.out.write(json.dumps(record) + '\n')
+        self.out.flush()
+        self.reset()
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+        self.enabled, self.out = False, None
+
+timers = Timers()
+
+def trace_profiler(path, name, wait, warmup, active):
+    """torch.profiler (cpu only, with memory) over a single wait/warmup/active window of steps.
+
+    Once the window is recorded the chrome trace is written to path/name.json and the operators
+    sorted by self cpu time and by self cpu memory to path/name.txt."""
+
+    def on_trace_ready(prof):
+        prof.export_chrome_trace(os.path.join(path, name + '.json'))
+        averages = prof.key_averages()
+        with open(os.path.join(path, name + '.txt'), 'w') as f:
+            f.write(averages.table(sort_by='self_cpu_time_total', row_limit=50) + '\n')
+            f.write(averages.table(sort_by='self_cpu_memory_usage', row_limit=20) + '\n')
+        print('| profiler | {} steps of {} written to {}'.format(active, name, os.path.join(path, name + '.json')))
+
+    os.makedirs(path, exist_ok=True)
+    return torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                  schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                                  on_trace_ready=on_trace_ready, profile_memory=True, record_shapes=True)
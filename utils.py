@@ -1,3 +1,7 @@
+import os
+import argparse
+import resource
+import numpy as np
 import torch
 
 
@@ -10,46 +14,81 @@ def repackage_hidden(h):
         return tuple(repackage_hidden(v) for v in h)
 
 
-def batchify(data, bsz, args):
+def memory_usage():
+    """Returns (resident, private) memory of this process in MB. Pages of shared memory-mapped
+    files count towards the resident but not the private memory."""
+    if os.path.exists('/proc/self/smaps_rollup'):
+        fields = {}
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) / 1024.
+        return fields['Rss'], fields['Private_Clean'] + fields['Private_Dirty']
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return peak, peak
+
+def shared_tensor(path, build):
+    """Memory-maps the tensor stored at path, it is built with build() and published first if needed."""
+    if not os.path.exists(path):
+        # every job writes its own temporary file, so concurrent builders never publish a partial one
+        tmp = '{}.{}.tmp.npy'.format(path, os.getpid())
+        np.save(tmp, build().numpy())
+        os.replace(tmp, path)
+    return torch.from_numpy(np.load(path, mmap_mode='c'))
+
+def batchify(data, bsz, args, name=None):
+
+    # Batches of named streams are shared between jobs through --shared_data.
+    shared_data = getattr(args, 'shared_data', '')
+    if name is not None and shared_data and bsz > 1:
+        path = os.path.join(shared_data, '{}.{}.npy'.format(name, bsz))
+        data = shared_tensor(path, lambda: batchify(data, bsz, argparse.Namespace(cuda=False)))
+        return data.cuda() if args.cuda else data
 
     # Work out how cleanly we can divide the dataset into bsz parts.
     nbatch = data.size(0) // bsz
     # Trim off any extra elements that wouldn't cleanly fit (remainders).
     data = data.narrow(0, 0, nbatch * bsz)
-    # Evenly divide the data across the bsz batches.
-    data = data.view(bsz, -1).t().contiguous()
+    # Evenly divide the data across the bsz batches (binary corpora store narrow ids).
+    data = data.view(bsz, -1).t().contiguous().long()
     if args.cuda:
         data = data.cuda()
     return data
 
-def batchify_padded(data, bsz, args, ntokens, eos_tokens):
-
-    i, batches, seq_lens = 0, [], []
-    while i < data.size(0):
-
-        # get the sentences
-        j, sentences = i, [i]
-        while j < data.size(0) and len(sentences) < bsz+1:
-            if int(data[j].data.cpu().numpy()) in eos_tokens:
-                sentences.append(j+1)
-            j += 1
-
-        i = j
-
-        # find longest sentence
-        lengths = [sentences[j+1] - sentences[j] for j in range(len(sentences)-1)]
-        longest = max(lengths)
-        seq_lens.append(longest)
-        #print(seq_lens)
+def sentence_boundaries(data, eos_tokens):
+    """Returns start offsets and lengths of all sentences in the id stream.
+    A sentence ends right after every eos token, tokens after the last eos are dropped."""
+    is_eos = sum(data == eos for eos in eos_tokens) > 0
+    ends = is_eos.nonzero().view(-1) + 1
+    starts = torch.cat((ends.new_zeros(1), ends[:-1]))
+    return starts, ends - starts
 
-        # initialize empty container
-        batch = (torch.ones(bsz, longest) * (ntokens-1)).type(torch.LongTensor).cuda()
-        for j in range(len(sentences)-1): 
-            batch[j][0:lengths[j]] = data[sentences[j]:sentences[j+1]]
+def batchify_padded(data, bsz, args, ntokens, eos_tokens):
 
-        batches.append(torch.t(batch))
+    data = data.long()
+    starts, lengths = sentence_boundaries(data, eos_tokens)
+
+    # sentence id and position within the sentence of every token
+    ntok = int(lengths.sum())
+    sentence = torch.arange(len(lengths)).repeat_interleave(lengths)
+    position = torch.arange(ntok) - starts[sentence]
+
+    # every bsz consecutive sentences form a batch padded to the longest one
+    nbatch = (len(lengths) + bsz - 1) // bsz
+    padded = torch.cat((lengths, lengths.new_zeros(nbatch * bsz - len(lengths))))
+    longest = padded.view(nbatch, bsz).max(1)[0]
+    offsets = longest.cumsum(0) - longest
+
+    # scatter all tokens into the (sum(longest) x bsz) output in one go
+    row = offsets[sentence // bsz] + position
+    batches = torch.ones(int(longest.sum()) * bsz).long() * (ntokens-1)
+    batches.scatter_(0, row * bsz + sentence % bsz, data[:ntok])
+    batches = batches.view(-1, bsz)
+    if args.cuda:
+        batches = batches.cuda()
 
-    return torch.cat(batches, 0), seq_lens
+    return batches, longest.tolist()
 
 
 def get_batch(source, i, args, seq_len=None, evaluation=False, eos_tokens=None):
@@ -59,3 +98,23 @@ def get_batch(source, i, args, seq_len=None, evaluation=False, eos_tokens=None):
         data = source[i:i+1+seq_len]
 
     return data
+
+
+class SpectralNorm(object):
+    """Tracks the largest singular value of a slowly changing matrix by power iteration. The right
+    singular vector is kept between calls, so every update only costs a few matrix-vector products."""
+
+    def __init__(self, niter=2):
+        self.niter = niter
+        self.v = None
+
+    def __call__(self, weight, niter=None):
+        with torch.no_grad():
+            w = weight.detach()
+            if self.v is None or self.v.size(0) != w.size(1):
+                # deterministic start, the random number generators of training are not touched
+                self.v = torch.ones(w.size(1), dtype=w.dtype, device=w.device) / w.size(1) ** 0.5
+            for _ in range(self.niter if niter is None else niter):
+                u = torch.nn.functional.normalize(torch.mv(w, self.v), dim=0)
+                self.v = torch.nn.functional.normalize(torch.mv(w.t(), u), dim=0)
+            return torch.mv(w, self.v).norm().item()
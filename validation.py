@@ -0,0 +1,165 @@
+import os
+import hashlib
+import numpy as np
+import torch
+
+from utils import sentence_boundaries
+
+
+def bootstrap_ci(sums, counts, nboot=1000, alpha=0.05, seed=0):
+    """Percentile bootstrap confidence interval of the per-token loss sum(sums) / sum(counts),
+    resampling whole units (sentences or segments)."""
+    rng = np.random.RandomState(seed)
+    idx = rng.randint(0, len(sums), size=(nboot, len(sums)))
+    estimates = sums[idx].sum(1) / counts[idx].sum(1)
+    return np.percentile(estimates, 100 * alpha / 2), np.percentile(estimates, 100 * (1 - alpha / 2))
+
+
+class SubsampledValidation(object):
+    """Estimates the validation loss on a fixed, seeded random subset of the data.
+
+    With eos_tokens the units are sentences, otherwise the stream is cut into segments
+    of seg_len tokens. Every unit is scored from a fresh hidden state."""
+
+    def __init__(self, data, nunits, eos_tokens=None, seg_len=70, seed=1111):
+
+        stream = data.view(-1).cpu()
+        if eos_tokens is not None:
+            starts, lengths = sentence_boundaries(stream, eos_tokens)
+        else:
+            starts = torch.arange(0, len(stream), seg_len)
+            lengths = (len(stream) - starts).clamp(max=seg_len)
+
+        rng = np.random.RandomState(seed)
+        chosen = np.sort(rng.choice(len(starts), min(nunits, len(starts)), replace=False))
+        starts, self.lengths = starts[chosen], lengths[chosen].numpy()
+
+        # the chosen units are concatenated into a single stream
+        index = torch.cat([torch.arange(s, s + l) for s, l in zip(starts.tolist(), self.lengths.tolist())])
+        self.data = data[index.to(data.device)]
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths)[:-1]))
+        self.resets = set(self.offsets.tolist())
+        self.fraction = float(self.lengths.sum()) / len(stream)
+        self.seed = seed
+
+    def evaluate(self, model, eos_tokens=None, nboot=1000, alpha=0.05, cache=None):
+        # returns the estimated per-token loss and its (1 - alpha) bootstrap confidence interval
+        score = lambda: model.evaluate(self.data, eos_tokens, resets=self.resets)
+        if cache is not None:
+            _, entropy = cache.evaluate(model, self.data, eos_tokens, score, setting=('resets', tuple(self.offsets.tolist())))
+        else:
+            _, entropy = score()
+        sums = np.add.reduceat(entropy, self.offsets)
+        estimate = sums.sum() / self.lengths.sum()
+        return estimate, bootstrap_ci(sums, self.lengths, nboot, alpha, self.seed)
+
+
+def init_shard_worker(threads):
+    torch.set_num_threads(threads)
+
+def score_shard(model, data, eos_tokens, bound=None, progress=None, index=None, chunk=100):
+    # with bound (a total over all shards), progress[index] holds the loss summed by this shard so far and
+    # the shard is scored in chunks of sentences, it stops once the sum over all shards exceeds the bound
+    model.eval()
+    if bound is None:
+        return model.evaluate(data, eos_tokens)[1]
+    entropy = []
+    for lo, hi in shard_bounds(data, eos_tokens, max(1, data.size(0) // chunk)):
+        _, part = model.evaluate(data[lo:hi], eos_tokens, bound=(bound - progress.sum().item()) / (hi - lo))
+        entropy.append(part)
+        progress[index] += float(part.sum())
+        if progress.sum().item() > bound:
+            break
+    return np.concatenate(entropy)
+
+def score_snapshot(model, data, eos_tokens, bound=None):
+    model.eval()
+    return model.evaluate(data, eos_tokens, bound=bound)
+
+def shard_bounds(data, eos_tokens, nshards):
+    """Cuts the stream at sentence ends into at most nshards pieces of about equal token count."""
+    stream = data.view(-1).cpu()
+    _, lengths = sentence_boundaries(stream, eos_tokens)
+    ends = lengths.cumsum(0).numpy()
+    targets = np.arange(1, nshards) * len(stream) / nshards
+    cuts = np.unique(ends[np.minimum(np.searchsorted(ends, targets), len(ends) - 1)]) if len(ends) > 0 else []
+    bounds = [0] + [int(c) for c in cuts if 0 < c < len(stream)] + [len(stream)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def evaluate_sharded(model, data, eos_tokens, pool, nshards, bound=None):
+    """Scores the sentences of data in the worker processes of pool and returns the same loss and
+    per-token entropy as model.evaluate(data, eos_tokens, bound=bound). Requires a model on the cpu and
+    eos_tokens, since only then the hidden state is reset between sentences and shards are independent.
+
+    The shards share their running loss sums, all of them stop as soon as these show that the loss of
+    the whole data exceeds bound. The returned loss is then a lower bound and the entropy is truncated."""
+
+    # the weights are moved to shared memory once and only their handles are sent to the workers
+    model.eval()
+    model.rnn._setweights()
+    model.share_memory()
+
+    bounds = shard_bounds(data, eos_tokens, nshards)
+    if bound is None:
+        shards = [(model, data[lo:hi], eos_tokens) for lo, hi in bounds]
+    else:
+        # the loss sum of every shard so far, in shared memory like the weights
+        progress = torch.zeros(len(bounds), dtype=torch.float64).share_memory_()
+        shards = [(model, data[lo:hi], eos_tokens, bound * data.size(0), progress, k) for k, (lo, hi) in enumerate(bounds)]
+    entropy = np.concatenate(pool.starmap(score_shard, shards))
+    return entropy.sum() / data.size(0), entropy
+
+
+class EvaluationCache(object):
+    """On-disk cache of (loss, per-token entropy) results of model.evaluate.
+
+    Entries are addressed by a hash of everything the result depends on: the parameters of the model,
+    its temperature and distance function, the data stream and the eos_tokens, plus an optional setting
+    for results that are not those of a plain pass (e.g. sampled estimates). The entropy is stored
+    as float32, a hit therefore returns it at that precision."""
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.hits, self.misses = 0, 0
+
+    def key(self, model, data, eos_tokens, setting=None):
+        h = hashlib.sha1()
+        for name, tensor in sorted(model.state_dict().items()):
+            h.update(name.encode())
+            h.update(tensor.detach().cpu().numpy().tobytes())
+        h.update(repr((model.temp, model.dist_fn.__name__, None if eos_tokens is None else sorted(eos_tokens))).encode())
+        if setting is not None:
+            h.update(repr(setting).encode())
+        h.update(data.cpu().numpy().astype(np.int64).tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        fn = os.path.join(self.path, key + '.npz')
+        if not os.path.exists(fn):
+            self.misses += 1
+            return None
+        self.hits += 1
+        with np.load(fn) as f:
+            return float(f['loss']), f['entropy']
+
+    def put(self, key, loss, entropy):
+        # written to a temporary file first, concurrent jobs may share the cache directory
+        fn = os.path.join(self.path, key + '.npz')
+        with open(fn + '.' + str(os.getpid()), 'wb') as f:
+            np.savez(f, loss=loss, entropy=np.asarray(entropy, dtype=np.float32))
+        os.replace(fn + '.' + str(os.getpid()), fn)
+
+    def evaluate(self, model, data, eos_tokens, score, setting=None):
+        # score() computes (loss, entropy) on a miss, incomplete (aborted) results are not stored
+        key = self.key(model, data, eos_tokens, setting)
+        result = self.get(key)
+        if result is None:
+            result = score()
+            if len(result[1]) == data.size(0):
+                self.put(key, *result)
+        return result
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total > 0 else 0.}
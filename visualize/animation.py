@@ -1,18 +1,22 @@
-import glob, os
+import glob, os, time, resource
 import numpy as np
+from collections import OrderedDict
 from dump import load_contexts
 
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 from matplotlib.animation import FuncAnimation, writers
 plt.rcParams['animation.ffmpeg_path'] = '/usr/local/bin/ffmpeg'
 
 
 class Animation:
 
-	def __init__(self, dir, snapshot_mode = False, xlim=None, ylim=None):
+	def __init__(self, dir, snapshot_mode = False, xlim=None, ylim=None, nlines=16*10, cache_size=8):
+
+		self.start_time = time.time()
 		
-		# determine all files
-		self.files = [file for file in glob.glob(dir + "context_dump_*")]
+		# determine all files (text or binary dumps)
+		self.files = [file for file in glob.glob(dir + "context_dump_*") if os.path.splitext(file)[1] in ('.out', '.npy')]
 
 		# extract all epoch numbers
 		self.epochs = [os.path.splitext(file)[0] for file in self.files]
@@ -21,8 +25,11 @@ class Animation:
 		# sort both lists by epoch
 		self.epochs, self.files = (list(t) for t in zip(*sorted(zip(self.epochs, self.files))))
 
-		# load data for each epoch
-		self.data = np.array([load_contexts(file) for file in self.files])
+		# frames are loaded when they are drawn, the last cache_size frames are kept
+		self.nlines = nlines
+		self.cache_size = cache_size
+		self.cache = OrderedDict()
+		self.first_frame = True
 
 		# limits
 		if xlim is None:
@@ -61,32 +68,39 @@ class Animation:
 		self.plot =	self.ax.plot()
 		return self.plot,
 
-	def _draw_next_snapshot(self, i):
+	def _load_frame(self, i):
+		# returns the last nlines rows and the maximal depth of frame i
+		if i in self.cache:
+			self.cache.move_to_end(i)
+			return self.cache[i]
 
-		self._clear(self.epochs[i])
+		data = load_contexts(self.files[i])
+		frame = np.array(data[-self.nlines:]), np.amax(data[:,1])
+		self.cache[i] = frame
+		if len(self.cache) > self.cache_size:
+			self.cache.popitem(last=False)
+		return frame
 
-		data = self.data[i,:,:]
-		max_depth = np.amax(data[:,1])
-		hsz = (np.size(data, 1) - 2) // 2
+	def _draw_next_snapshot(self, i):
 
-		line_color_index = 0
-		for i in range(np.size(data,0) - 16*10, np.size(data, 0)):
+		self._clear(self.epochs[i])
 
-			if data[0,0] == 0:
-				line_color = self.colors[line_color_index]
-				#line_color_index = (line_color_index + 1) % len(self.colors)
+		data, max_depth = self._load_frame(i)
 
-			c2 = plt.cm.Greys(float((max_depth-data[i,1]))/max_depth)
-			if data[i,0] == 0:
-				c1 = plt.cm.Reds(0.75)
-			else:
-				c1 = plt.cm.Greys(float((max_depth-data[i,0]))/max_depth)
+		# all segments in one collection, the nodes are colored by depth (roots in red)
+		segments = np.stack([-data[:,2:4], -data[:,4:6]], axis=1)
+		self.ax.add_collection(LineCollection(segments, colors=self.colors[0]))
 
-			print(data[i:i+17,:])
-			plt.plot([-data[i,2], -data[i,4]], [-data[i,3], -data[i,5]], line_color)
-			plt.plot(-data[i,2], -data[i,3], marker='.', markeredgecolor='k', markerfacecolor=c1)
-			plt.plot(-data[i,4], -data[i,5], marker='.', markerfacecolor=c2, markeredgecolor='k')
+		c1 = plt.cm.Greys((max_depth-data[:,0])/max_depth)
+		c1[data[:,0] == 0] = plt.cm.Reds(0.75)
+		c2 = plt.cm.Greys((max_depth-data[:,1])/max_depth)
+		self.ax.scatter(-data[:,2], -data[:,3], marker='.', facecolors=c1, edgecolors='k', zorder=2)
+		self.ax.scatter(-data[:,4], -data[:,5], marker='.', facecolors=c2, edgecolors='k', zorder=2)
 
+		if self.first_frame:
+			self.first_frame = False
+			print('time to first frame {:5.2f}s | peak memory {:8.1f} MB'.format(
+				time.time() - self.start_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
 
 		return self.plot
 
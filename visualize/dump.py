@@ -1,16 +1,46 @@
+import os
+import json
+import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 
-def dump(data, basepath=''):
+# every dump function takes fmt='txt' (text written by np.savetxt to basepath.out, the original format)
+# or fmt='npy' (binary float32 written to basepath.npy, column names in basepath.json if there are any)
+
+def save_npy(data, basepath, columns=None):
+	np.save(basepath + '.npy', data)
+	if columns is not None:
+		with open(basepath + '.json', 'w') as f:
+			json.dump({'columns': columns, 'shape': list(data.shape), 'dtype': str(data.dtype)}, f)
+
+def load(path):
+	""" loads a dump written in either format, path is the file itself or the basepath it was
+		dumped to (then the .npy file is preferred), .npy files are memory-mapped
+	"""
+	if not os.path.exists(path):
+		path = path + '.npy' if os.path.exists(path + '.npy') else path + '.out'
+	if path.endswith('.npy'):
+		return np.load(path, mmap_mode='r')
+	return np.loadtxt(path)
+
+def convert(path):
+	# converts a text dump path (.out) to a .npy file next to it
+	data = np.loadtxt(path).astype(np.float32)
+	np.save(os.path.splitext(path)[0] + '.npy', data)
+	return os.path.splitext(path)[0] + '.npy'
+
+def dump(data, basepath='', fmt='txt'):
+	if fmt == 'npy':
+		return save_npy(np.asarray(data, dtype=np.float32), basepath)
 	savepath = basepath + '.out'
 	np.savetxt(savepath, data)
 
-def dump_hiddens(hiddens, basepath=''):
+def dump_hiddens(hiddens, basepath='', fmt='txt'):
 	# hiddens is a list of list
 
 	n_hiddens = sum([len(h) for h in hiddens])
 	n_dims = hiddens[0][0].shape[1]
-	data = np.zeros((n_hiddens, n_dims+1))
+	data = np.zeros((n_hiddens, n_dims+1), dtype=np.float32 if fmt == 'npy' else np.float64)
 
 	offset = 0
 	for hidden in hiddens:
@@ -20,39 +50,80 @@ def dump_hiddens(hiddens, basepath=''):
 
 		offset += len(hidden)
 
+	if fmt == 'npy':
+		return save_npy(data, basepath, ['depth'] + ['h' + str(k) for k in range(n_dims)])
+
 	savepath = basepath + '.out'
 	formatstr= ' '.join(['%i'] + ['%1.4e']*n_dims)
 	np.savetxt(savepath, data, delimiter=' ', fmt=formatstr)
 
-def dump_words(words, basepath=''):
+class HiddenWriter:
+
+	""" streams hidden states into preallocated memory-mapped .npy files while evaluating:
+		basepath.npy (n x nhid), basepath.depth.npy (position in the sentence) and
+		basepath.sentence.npy (sentence id), memory use does not grow with n
+	"""
+
+	def __init__(self, basepath, n, nhid):
+		self.basepath = basepath
+		self.hiddens = np.lib.format.open_memmap(basepath + '.npy', mode='w+', dtype=np.float32, shape=(n, nhid))
+		self.depth = np.lib.format.open_memmap(basepath + '.depth.npy', mode='w+', dtype=np.int32, shape=(n,))
+		self.sentence = np.lib.format.open_memmap(basepath + '.sentence.npy', mode='w+', dtype=np.int64, shape=(n,))
+
+	def write(self, i, hidden, depth, sentence):
+		self.hiddens[i] = hidden.detach().cpu().numpy().reshape(-1)
+		self.depth[i] = depth
+		self.sentence[i] = sentence
+
+	def close(self):
+		for data in [self.hiddens, self.depth, self.sentence]:
+			data.flush()
+		with open(self.basepath + '.json', 'w') as f:
+			json.dump({'columns': ['h' + str(k) for k in range(self.hiddens.shape[1])], 'shape': list(self.hiddens.shape),
+						'dtype': 'float32', 'sidecars': ['depth', 'sentence']}, f)
+
+def load_hiddens(path):
+	# returns hiddens, depth and sentence ids of a dump of either format
+	if os.path.exists(path + '.depth.npy'):
+		return load(path + '.npy'), load(path + '.depth.npy'), load(path + '.sentence.npy')
+	data = load(path)
+	depth = data[:, 0].astype(np.int32)
+	return data[:, 1:], depth, np.cumsum(depth == 0) - 1
+
+def dump_words(words, basepath='', fmt='txt'):
 	# words is numpy array 
 	nrows, ncols = words.shape
 
+	if fmt == 'npy':
+		return save_npy(words.astype(np.float32), basepath)
+
 	savepath = basepath + '.out'
 	formatstr= ' '.join(['%1.4e']*ncols)
 	np.savetxt(savepath, words, delimiter=' ', fmt=formatstr)
 
 
 
-def dump_val_loss(val_loss, epochs, basepath=''):
+def dump_val_loss(val_loss, epochs, basepath='', fmt='txt'):
+	if fmt == 'npy':
+		return save_npy(np.asarray(val_loss, dtype=np.float32), basepath)
 	savepath = basepath + '.out'
 	formatstr= ' '.join(['%1.4e']*epochs)
 	np.savetxt(savepath, val_loss, delimiter=' ', fmt=formatstr)
 
 def load_val_loss(path):
-	val_loss = np.loadtxt(path)
+	val_loss = load(path)
 	return val_loss
 
-def dump_contexts(contexts, basepath='', epoch=0, hsz=2, bsz=1):
+def dump_contexts(contexts, basepath='', epoch=0, hsz=2, bsz=1, fmt='txt'):
 
 	""" format: 
 		- one row per line {depth1, depth2, x1, y1, x2, y2 }
 	"""
-	
+
 	# the overall number of lines is sum(bsz*(seq_len)) over all contexts
 	nlines = sum([len(ctxts)-bsz for ctxts in contexts])
 	data = np.zeros((nlines, 2*hsz + 2))
-	
+
 	n = 0
 	for ctxts in contexts:
 
@@ -74,13 +145,29 @@ def dump_contexts(contexts, basepath='', epoch=0, hsz=2, bsz=1):
 
 				n += 1
 
+	if fmt == 'npy':
+		columns = ['depth1', 'depth2'] + ['context1_' + str(k) for k in range(hsz)] + ['context2_' + str(k) for k in range(hsz)]
+		return save_npy(data.astype(np.float32), basepath + str(epoch), columns)
+
 	savepath = basepath + str(epoch) + '.out'
 	header = "depth 1, depth 2, context1, context2"
 	formatstr = ' '.join(['%i']*2 + ['%1.8e']*2*hsz)
 	np.savetxt(savepath, data, header=header, delimiter=' ', fmt=formatstr)
 
 def load_contexts(path):
-	data = np.loadtxt(path)
+	data = load(path)
 	return data
 
 
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Convert text dumps (.out) to the binary .npy format')
+	parser.add_argument('files', nargs='+', help='.out files to convert')
+	parser.add_argument('--remove', action='store_true', help='remove the .out file after converting it')
+	args = parser.parse_args()
+
+	for path in args.files:
+		npy_path = convert(path)
+		print('{} -> {} ({:5.1f}x smaller)'.format(path, npy_path, os.path.getsize(path) / os.path.getsize(npy_path)))
+		if args.remove:
+			os.remove(path)
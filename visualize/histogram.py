@@ -3,6 +3,8 @@ import numpy as np
 import itertools
 import matplotlib.pyplot as plt
 import matplotlib
+from dump import load
+from summary import EvaluationSummary
 
 #path = '../results/lstm_results/adam-0.001-0.4-distance-10.out'
 #data = np.loadtxt(path)
@@ -91,12 +93,23 @@ def density_scatter( x , y, ax = None, sort = True, bins = 20, **kwargs )   :
 	ax.scatter( x, y, c=z, cmap='magma', **kwargs)
 	return ax
 
+def density_heatmap(summary, ax):
+	"""
+	Heatmap of the joint entropy-distance histogram of an EvaluationSummary
+	"""
+	joint = summary.joint_hist[1:-1, 1:-1].T
+	ax.pcolormesh(summary.distance_bins, summary.entropy_bins, np.ma.masked_equal(joint, 0), cmap='magma')
+	return ax
+
 class EntropyDistance2D:
 
-	def __init__(self, base, optimizer, learning_rate, regularizer, epochs):
+	def __init__(self, base, optimizer, learning_rate, regularizer, epochs, summaries=False):
 
 		self.epochs = epochs
 
+		# with summaries, the joint histograms of main.py --dump_summary are plotted instead of the per-token dumps
+		self.summaries = summaries
+		self.summary_bases = [base + 'adam-0.0001-0.0-summary_', base + 'sgd-10.0-0.0-summary_']
 		self.distance_bases = [base + 'adam-0.0001-0.0-distance-', base + 'sgd-10.0-0.0-distance-']
 		self.entropy_bases = [base + 'adam-0.0001-0.0-entropy-', base +  'sgd-10.0-0.0-entropy-']
 
@@ -114,11 +127,9 @@ class EntropyDistance2D:
 			
 			for j, epoch in enumerate(self.epochs):
 
-				distance_path = distance_base + str(epoch) + '.out'
-				entropy_path = entropy_base + str(epoch) + '.out'
-
-				distance = np.loadtxt(distance_path)
-				entropy = np.loadtxt(entropy_path)
+				if not self.summaries:
+					distance = load(distance_base + str(epoch))
+					entropy = load(entropy_base + str(epoch))
 
 				idx = 2*(j+1) - i
 				ax = self.fig.add_subplot(nrows, ncols, idx)
@@ -130,7 +141,10 @@ class EntropyDistance2D:
 				ax.set_xlabel('Similarity')
 
 				if j == 0: ax = self._make_col_title(ax, 'adam' if i == 0 else 'sgd')
-				density_scatter(distance, entropy, ax=ax, bins=nbins)
+				if self.summaries:
+					density_heatmap(EvaluationSummary.load(self.summary_bases[i] + str(epoch)), ax)
+				else:
+					density_scatter(distance, entropy, ax=ax, bins=nbins)
 
 	def _make_col_title(self, ax, title, pad=5):
 		ax.annotate(title, xy=(0.5, 1), xytext=(0, 3*pad),
@@ -143,14 +157,16 @@ class EntropyDistance2D:
 
 class EntropyHistogram:
 
-	def __init__(self, base, epochs):
+	def __init__(self, base, epochs, summaries=False):
 
 		self.epochs = epochs
 
-		self.entropie_paths = [base + 'entropy_' + str(epoch) + '.out' for epoch in epochs]
+		# with summaries, the histograms of main.py --dump_summary are plotted instead of the per-token dumps
+		self.summaries = summaries
+		self.entropie_paths = [base + ('summary_' if summaries else 'entropy_') + str(epoch) for epoch in epochs]
 		self.entropy = dict()
 		for epoch, path in zip(epochs, self.entropie_paths):
-			self.entropy[epoch] = np.loadtxt(path)
+			self.entropy[epoch] = EvaluationSummary.load(path) if summaries else load(path)
 
 		self.valid_path = base + 'val_loss.out.out'
 		#self.valid = np.loadtxt(self.valid_path)
@@ -195,8 +211,13 @@ class EntropyHistogram:
 			#ax = self._make_col_title(ax, epoch)
 
 			ax.ticklabel_format(style='sci', axis='y', scilimits=(0,0))
-			ax.hist(self.entropy[epoch], ebins, edgecolor='black', color='white')
-			ax.axvline(np.mean(self.entropy[epoch]), color='r', linestyle='dashed', label='avrg. entropy')
+			if self.summaries:
+				summary = self.entropy[epoch]
+				ax.stairs(summary.entropy_hist[1:-1], summary.entropy_bins, fill=True, edgecolor='black', facecolor='white')
+				ax.axvline(summary.entropy_mean(), color='r', linestyle='dashed', label='avrg. entropy')
+			else:
+				ax.hist(self.entropy[epoch], ebins, edgecolor='black', color='white')
+				ax.axvline(np.mean(self.entropy[epoch]), color='r', linestyle='dashed', label='avrg. entropy')
 			ax.legend(loc='upper right')
 			ax.set_xlabel('Entropy (Epoch: ' + str(epoch) + ')')
 			if i == 0: ax.set_ylabel('Counts')
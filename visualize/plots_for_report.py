@@ -1,6 +1,7 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import cm
+from dump import load
 
 def plot_bias(btm=-6, top=0.5, left=-100, right=10100, epochs=[1, 5, 15, 25]):
 
@@ -12,7 +13,7 @@ def plot_bias(btm=-6, top=0.5, left=-100, right=10100, epochs=[1, 5, 15, 25]):
 
 	data = []
 	for epoch in epochs:
-		data.append(np.loadtxt('bias_' + str(epoch) + '.out.out'))
+		data.append(load('bias_' + str(epoch) + '.out'))
 
 	fig = plt.figure(figsize=(8, 8))
 	fig.suptitle('Token Biases', fontsize=14)
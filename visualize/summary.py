@@ -0,0 +1,124 @@
+import numpy as np
+
+
+class QuantileSketch:
+
+	""" relative error quantile sketch (as DDSketch): values are counted in logarithmic buckets
+		gamma^(k-1) < |x| <= gamma^k with gamma = (1+alpha)/(1-alpha), every quantile is returned
+		with a relative error of at most alpha and two sketches are merged by adding their counts
+	"""
+
+	def __init__(self, alpha=0.01):
+		self.alpha = alpha
+		self.log_gamma = np.log((1 + alpha) / (1 - alpha))
+		self.positive, self.negative = dict(), dict()
+		self.zero, self.count = 0, 0
+
+	def update(self, values):
+		values = np.asarray(values, dtype=np.float64)
+		self.count += len(values)
+		self.zero += int(np.sum(values == 0))
+		for store, v in [(self.positive, values[values > 0]), (self.negative, -values[values < 0])]:
+			keys, counts = np.unique(np.ceil(np.log(v) / self.log_gamma).astype(np.int64), return_counts=True)
+			for k, c in zip(keys.tolist(), counts.tolist()):
+				store[k] = store.get(k, 0) + c
+
+	def merge(self, other):
+		for store, other_store in [(self.positive, other.positive), (self.negative, other.negative)]:
+			for k, c in other_store.items():
+				store[k] = store.get(k, 0) + c
+		self.zero += other.zero
+		self.count += other.count
+
+	def quantile(self, q):
+		# buckets in increasing order of their values, a bucket is represented by its midpoint
+		gamma = np.exp(self.log_gamma)
+		buckets = [(-2 * gamma**k / (gamma + 1), c) for k, c in sorted(self.negative.items(), reverse=True)]
+		buckets += [(0., self.zero)]
+		buckets += [(2 * gamma**k / (gamma + 1), c) for k, c in sorted(self.positive.items())]
+
+		rank, seen = q * (self.count - 1), 0
+		for value, c in buckets:
+			seen += c
+			if seen > rank:
+				return value
+		return buckets[-1][0]
+
+	def to_arrays(self, prefix):
+		return {prefix + 'positive': np.array(sorted(self.positive.items()), dtype=np.int64).reshape(-1, 2),
+				prefix + 'negative': np.array(sorted(self.negative.items()), dtype=np.int64).reshape(-1, 2),
+				prefix + 'zero': np.array([self.zero, self.count]), prefix + 'alpha': np.array(self.alpha)}
+
+	@staticmethod
+	def from_arrays(arrays, prefix):
+		sketch = QuantileSketch(float(arrays[prefix + 'alpha']))
+		sketch.positive = {int(k): int(c) for k, c in arrays[prefix + 'positive']}
+		sketch.negative = {int(k): int(c) for k, c in arrays[prefix + 'negative']}
+		sketch.zero, sketch.count = (int(x) for x in arrays[prefix + 'zero'])
+		return sketch
+
+
+class EvaluationSummary:
+
+	""" mergeable summary of the per-token entropy and target distance of an evaluation:
+		fixed-bin histograms of both, their joint 2d histogram and quantile sketches, the first and
+		last bins of the histograms count the values outside of the given ranges
+	"""
+
+	def __init__(self, entropy_range=(0, 30), distance_range=(-25, 25), nbins=100, alpha=0.01):
+		self.entropy_bins = np.linspace(entropy_range[0], entropy_range[1], nbins + 1)
+		self.distance_bins = np.linspace(distance_range[0], distance_range[1], nbins + 1)
+		self.entropy_hist = np.zeros(nbins + 2, dtype=np.int64)
+		self.distance_hist = np.zeros(nbins + 2, dtype=np.int64)
+		self.joint_hist = np.zeros((nbins + 2, nbins + 2), dtype=np.int64)
+		self.entropy_sketch, self.distance_sketch = QuantileSketch(alpha), QuantileSketch(alpha)
+		self.count, self.entropy_sum, self.distance_sum = 0, 0., 0.
+
+	def update(self, entropy, distance):
+		entropy, distance = np.asarray(entropy, dtype=np.float64), np.asarray(distance, dtype=np.float64)
+		e = np.searchsorted(self.entropy_bins, entropy, side='right')
+		d = np.searchsorted(self.distance_bins, distance, side='right')
+		self.entropy_hist += np.bincount(e, minlength=len(self.entropy_hist))
+		self.distance_hist += np.bincount(d, minlength=len(self.distance_hist))
+		np.add.at(self.joint_hist, (d, e), 1)
+		self.entropy_sketch.update(entropy)
+		self.distance_sketch.update(distance)
+		self.count += len(entropy)
+		self.entropy_sum += entropy.sum()
+		self.distance_sum += distance.sum()
+
+	def merge(self, other):
+		self.entropy_hist += other.entropy_hist
+		self.distance_hist += other.distance_hist
+		self.joint_hist += other.joint_hist
+		self.entropy_sketch.merge(other.entropy_sketch)
+		self.distance_sketch.merge(other.distance_sketch)
+		self.count += other.count
+		self.entropy_sum += other.entropy_sum
+		self.distance_sum += other.distance_sum
+
+	def entropy_mean(self):
+		return self.entropy_sum / max(1, self.count)
+
+	def distance_mean(self):
+		return self.distance_sum / max(1, self.count)
+
+	def save(self, basepath):
+		arrays = dict(entropy_bins=self.entropy_bins, distance_bins=self.distance_bins, entropy_hist=self.entropy_hist,
+					distance_hist=self.distance_hist, joint_hist=self.joint_hist,
+					sums=np.array([self.count, self.entropy_sum, self.distance_sum]))
+		arrays.update(self.entropy_sketch.to_arrays('entropy_sketch_'))
+		arrays.update(self.distance_sketch.to_arrays('distance_sketch_'))
+		np.savez_compressed(basepath + '.npz', **arrays)
+
+	@staticmethod
+	def load(path):
+		with np.load(path if path.endswith('.npz') else path + '.npz') as arrays:
+			summary = EvaluationSummary()
+			summary.entropy_bins, summary.distance_bins = arrays['entropy_bins'], arrays['distance_bins']
+			summary.entropy_hist, summary.distance_hist = arrays['entropy_hist'], arrays['distance_hist']
+			summary.joint_hist = arrays['joint_hist']
+			summary.count, summary.entropy_sum, summary.distance_sum = int(arrays['sums'][0]), arrays['sums'][1], arrays['sums'][2]
+			summary.entropy_sketch = QuantileSketch.from_arrays(arrays, 'entropy_sketch_')
+			summary.distance_sketch = QuantileSketch.from_arrays(arrays, 'distance_sketch_')
+		return summary